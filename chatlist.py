@@ -0,0 +1,195 @@
+"""
+Консольный запуск сравнения без GUI (PyQt6 не импортируется):
+
+    python -m chatlist run prompts.jsonl --out results.jsonl --concurrency 8
+
+Каждая строка входного JSONL - тройной промпт: ключи p1/p2/p3, либо prompt, либо title/body
+(как в requests.jsonl; title идет в P1, body - в P2). Промпт рассылается всем активным моделям с ключами,
+ответы по мере готовности пишутся в SQLite (таблица results) и, если задан --out, в JSONL.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import uuid
+import db
+import db_writer
+import models_logic
+import network
+
+logger = logging.getLogger("ChatList.cli")
+
+DEFAULT_CONCURRENCY = 4
+
+def read_prompts(path):
+    """Тройные промпты из JSONL: список (id, p1, p2, p3). Пустые и нераспознанные строки пропускаются."""
+    prompts = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.error(f"{path}:{line_no}: invalid JSON ({e}), skipped")
+                continue
+            if "p1" in item or "p2" in item or "p3" in item:
+                parts = (item.get("p1"), item.get("p2"), item.get("p3"))
+            elif "prompt" in item:
+                parts = (item["prompt"], None, None)
+            else:
+                parts = (item.get("title"), item.get("body"), None)
+            parts = tuple((p or "").strip() for p in parts)
+            if not any(parts):
+                logger.error(f"{path}:{line_no}: no prompt text, skipped")
+                continue
+            prompt_id = item.get("request_id") or item.get("id") or str(line_no)
+            prompts.append((str(prompt_id), *parts))
+    return prompts
+
+def select_models(names):
+    """Активные модели с ключами в .env; names - необязательный список имен для отбора."""
+    models = models_logic.get_active_models_with_keys()
+    if names:
+        wanted = set(names)
+        models = [m for m in models if m[0] in wanted]
+        missing = wanted - {m[0] for m in models}
+        if missing:
+            logger.warning(f"Not active or without API key: {', '.join(sorted(missing))}")
+    return models
+
+def settings_defaults():
+    """Параметры генерации по умолчанию - те же глобальные настройки, что и в окне программы."""
+    return {
+        "timeout": float(db.get_setting("request_timeout", 60.0)),
+        "temperature": float(db.get_setting("global_temp", 0.7)),
+        "max_tokens": int(float(db.get_setting("global_max_tokens", 2000))),
+        "top_p": float(db.get_setting("global_top_p", 1.0)),
+        "thinking": db.get_setting("global_thinking", "0") == "1",
+        "use_cache": db.get_setting("global_use_cache", "0") == "1",
+    }
+
+async def run_batch(prompts, models, params, concurrency, out=None, save=True):
+    """
+    Рассылает каждый промпт всем моделям. Одновременно выполняется не больше concurrency запросов
+    на все промпты вместе (поверх этого темп каждого провайдера регулирует scheduler).
+    Возвращает (успешных, ошибок, суммарная стоимость).
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    saves = []
+
+    async def fetch(prompt_id, run_id, p1, p2, p3, model):
+        name, api_url, api_key_name, _ = model
+        combined_prompt = "\n\n".join([p for p in [p1, p2, p3] if p])
+        async with semaphore:
+            res = await network.fetch_model_response(
+                name, api_url, api_key_name, combined_prompt, params["timeout"],
+                temperature=params["temperature"], max_tokens=params["max_tokens"], top_p=params["top_p"],
+                thinking=params["thinking"], use_cache=params["use_cache"], parts=(p1, p2, p3))
+        res.update({"prompt_id": prompt_id, "run_id": run_id, "p1": p1, "p2": p2, "p3": p3})
+        return res
+
+    tasks = []
+    for prompt_id, p1, p2, p3 in prompts:
+        # Один запуск на промпт, как одна рассылка в окне программы: по run_id журнал считает расход
+        run_id = uuid.uuid4().hex[:12]
+        tasks.extend(asyncio.ensure_future(fetch(prompt_id, run_id, p1, p2, p3, m)) for m in models)
+
+    ok = errors = 0
+    total_cost = 0.0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            res = await next_done
+            if res.get("provider_cost") is not None:
+                res["cost"] = res["provider_cost"]
+            else:
+                res["cost"] = db.estimate_cost(res["model"], res)
+            total_cost += res["cost"] or 0.0
+            if res["status"].startswith("Success"):
+                ok += 1
+            else:
+                errors += 1
+            logger.info(f"[{res['prompt_id']}] {res['model']}: {res['status']} ({res.get('resp_time') or 0:.1f}s)")
+            if save:
+                saves.append(db_writer.submit(db.save_results_batch, [res]))
+            if out is not None:
+                out.write(json.dumps({key: res.get(key) for key in (
+                    "prompt_id", "run_id", "model", "status", "response", "resp_time", "ttft", "tokens_per_sec",
+                    "prompt_tokens", "completion_tokens", "reasoning_tokens", "cached_tokens", "cost", "cached",
+                )}, ensure_ascii=False) + "\n")
+                out.flush()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if saves:
+            await asyncio.gather(*(asyncio.wrap_future(f) for f in saves), return_exceptions=True)
+    return ok, errors, total_cost
+
+async def run_command(args):
+    prompts = read_prompts(args.input)
+    if not prompts:
+        logger.error(f"No prompts in {args.input}")
+        return 2
+    models = select_models(args.models.split(",") if args.models else None)
+    if not models:
+        logger.error("No active models with API keys found in .env")
+        return 2
+
+    params = settings_defaults()
+    for key in ("timeout", "temperature", "max_tokens", "top_p"):
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    params["thinking"] = params["thinking"] or args.thinking
+    params["use_cache"] = params["use_cache"] or args.cache
+
+    logger.info(f"{len(prompts)} prompts x {len(models)} models, concurrency {args.concurrency}")
+    out = None
+    if args.out == "-":
+        out = sys.stdout
+    elif args.out:
+        out = open(args.out, "a", encoding="utf-8")
+    try:
+        ok, errors, cost = await run_batch(prompts, models, params, args.concurrency, out, save=not args.no_save)
+    finally:
+        if out is not None and out is not sys.stdout:
+            out.close()
+        await network.close_clients()
+    logger.info(f"Done: {ok} successful, {errors} failed, cost ${cost:.4f}")
+    return 0 if ok else 1
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="chatlist", description="ChatList без GUI: пакетное сравнение моделей.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="разослать промпты из JSONL всем активным моделям")
+    run.add_argument("input", help="JSONL с промптами (p1/p2/p3, prompt или title/body)")
+    run.add_argument("--out", help="дописывать результаты в этот JSONL ('-' - в stdout)")
+    run.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                     help=f"максимум одновременных запросов (по умолчанию {DEFAULT_CONCURRENCY})")
+    run.add_argument("--models", help="только эти модели (имена через запятую)")
+    run.add_argument("--no-save", action="store_true", help="не сохранять результаты в SQLite")
+    run.add_argument("--timeout", type=float, help="таймаут запроса, сек (по умолчанию - из настроек)")
+    run.add_argument("--temperature", type=float)
+    run.add_argument("--max-tokens", type=int)
+    run.add_argument("--top-p", type=float)
+    run.add_argument("--thinking", action="store_true", help="режим рассуждений")
+    run.add_argument("--cache", action="store_true", help="брать ответы из локального кеша")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        stream=sys.stderr)
+    db.init_db()
+    try:
+        return asyncio.run(run_command(args))
+    finally:
+        # Дописываем очередь фоновой записи до закрытия соединений
+        db_writer.shutdown()
+        db.close_connections()
+
+if __name__ == "__main__":
+    sys.exit(main())
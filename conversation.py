@@ -0,0 +1,75 @@
+import logging
+import db
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET_TOKENS = 8000
+MESSAGE_OVERHEAD_TOKENS = 4  # служебные токены роли и разметки на каждое сообщение
+RECAP_LINE_CHARS = 160
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов (≈4 символа на токен)."""
+    return max(1, len(text) // 4) if text else 0
+
+def messages_tokens(messages):
+    return sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+def budget_for(model_name):
+    """Бюджет контекста модели: context_budget:<модель>, иначе общий context_budget_tokens."""
+    value = db.get_setting(f"context_budget:{model_name}") or db.get_setting("context_budget_tokens", DEFAULT_BUDGET_TOKENS)
+    return int(float(value))
+
+class Conversation:
+    """История диалога с одной моделью в режиме сессии: пары (вопрос, ответ) по порядку."""
+    def __init__(self):
+        self.turns = []
+
+    def build_messages(self, system_prompt, user_content, budget):
+        """
+        Сообщения для очередного запроса: system (P1), последние ходы истории и новый вопрос.
+        Старые ходы, не влезающие в бюджет, заменяются кратким пересказом (первые строки вопросов).
+        """
+        head = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        tail = [{"role": "user", "content": user_content}]
+        available = budget - messages_tokens(head + tail)
+
+        kept = []
+        for question, answer in reversed(self.turns):
+            pair = [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+            cost = messages_tokens(pair)
+            if cost > available:
+                break
+            kept[:0] = pair
+            available -= cost
+
+        dropped = self.turns[:len(self.turns) - len(kept) // 2]
+        if dropped:
+            recap = "Earlier in this conversation the user asked about:\n" + "\n".join(
+                "- " + question.strip().split("\n", 1)[0][:RECAP_LINE_CHARS] for question, _ in dropped)
+            recap_message = {"role": "system", "content": recap}
+            if messages_tokens([recap_message]) <= available:
+                head = head + [recap_message]
+            logger.info(f"Session history trimmed: {len(dropped)} old turns left out of the request")
+        return head + kept + tail
+
+    def record(self, user_content, reply):
+        self.turns.append((user_content, reply))
+
+_sessions = {}
+
+def get_session(model_name):
+    session = _sessions.get(model_name)
+    if session is None:
+        session = _sessions[model_name] = Conversation()
+    return session
+
+def build_messages(model_name, system_prompt, user_content):
+    """Сообщения очередного хода сессии модели с учетом ее бюджета токенов."""
+    return get_session(model_name).build_messages(system_prompt, user_content, budget_for(model_name))
+
+def record_reply(model_name, user_content, reply):
+    get_session(model_name).record(user_content, reply)
+
+def reset():
+    """Новая сессия: истории всех моделей забываются."""
+    _sessions.clear()
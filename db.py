@@ -1,15 +1,109 @@
 import sqlite3
+import hashlib
+import json
+import math
 import os
+import re
+import logging
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from latency_sketch import LatencySketch
+
+logger = logging.getLogger(__name__)
 
 DB_NAME = "chatlist.db"
+# Ожидание блокировки: в тот же файл пишут QtSql-соединения ModelsManager, ResultsJournal и NotesManager
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 256
+
+# У каждого потока свое долгоживущее соединение (sqlite3-соединения нельзя делить между потоками)
+_local = threading.local()
+_connections = {}  # поток -> его соединение
+_connections_lock = threading.Lock()
+
+def _open_connection():
+    # isolation_level=None: транзакциями управляет transaction(), а не неявный BEGIN модуля sqlite3
+    conn = sqlite3.connect(DB_NAME, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                           check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    # WAL: читатели (в т.ч. QtSql) не блокируют писателя и наоборот
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
 def get_connection():
-    return sqlite3.connect(DB_NAME)
+    """Возвращает долгоживущее соединение текущего потока (создает при первом обращении)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.depth = 0
+        with _connections_lock:
+            _connections[threading.current_thread()] = conn
+    return conn
+
+@contextmanager
+def transaction():
+    """Пишущая транзакция на соединении потока. Вложенные вызовы оформляются как SAVEPOINT."""
+    conn = get_connection()
+    depth = _local.depth
+    if depth == 0:
+        # IMMEDIATE сразу берет блокировку записи и ждет busy_timeout вместо ошибки при повышении
+        conn.execute("BEGIN IMMEDIATE")
+    else:
+        conn.execute(f"SAVEPOINT sp_{depth}")
+    _local.depth = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        if depth == 0:
+            conn.execute("ROLLBACK")
+        else:
+            conn.execute(f"ROLLBACK TO sp_{depth}")
+            conn.execute(f"RELEASE sp_{depth}")
+        raise
+    else:
+        conn.execute("COMMIT" if depth == 0 else f"RELEASE sp_{depth}")
+    finally:
+        _local.depth = depth
+
+def close_connection():
+    """Закрывает соединение текущего потока (поток с собственным соединением вызывает это перед завершением)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        return
+    with _connections_lock:
+        _connections.pop(threading.current_thread(), None)
+    _local.__dict__.clear()
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+def close_connections():
+    """
+    Сбрасывает отложенные настройки и закрывает соединение текущего потока и соединения завершившихся потоков
+    (вызывается при выходе из приложения). Соединения живых потоков не трогаются: каждый закрывает свое сам.
+    """
+    flush_settings()
+    close_connection()
+    with _connections_lock:
+        orphaned = [(thread, conn) for thread, conn in _connections.items() if not thread.is_alive()]
+        for thread, _ in orphaned:
+            del _connections[thread]
+        still_open = [thread.name for thread in _connections]
+    for _, conn in orphaned:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    if still_open:
+        logger.warning(f"DB connections left open by running threads: {', '.join(still_open)}")
 
 def init_db():
     """Инициализация таблиц базы данных."""
-    with get_connection() as conn:
+    with transaction() as conn:
         cursor = conn.cursor()
         
         # Набор таблиц для первого типа промптов (стандартный)
@@ -35,16 +129,6 @@ def init_db():
             )
         """)
         
-        # Миграция: Проверяем наличие колонки full_prompt
-        cursor.execute("PRAGMA table_info(results)")
-        columns = [column[1] for column in cursor.fetchall()]
-        if 'full_prompt' not in columns:
-            cursor.execute("ALTER TABLE results ADD COLUMN full_prompt TEXT")
-        if 'resp_time' not in columns:
-            cursor.execute("ALTER TABLE results ADD COLUMN resp_time REAL")
-        if 'status' not in columns:
-            cursor.execute("ALTER TABLE results ADD COLUMN status TEXT")
-
         # Таблицы для второго типа промптов
         cursor.execute("CREATE TABLE IF NOT EXISTS prompts2 (id INTEGER PRIMARY KEY AUTOINCREMENT, date TEXT, prompt TEXT, tags TEXT)")
         cursor.execute("""
@@ -86,142 +170,795 @@ def init_db():
                 content TEXT
             )
         """)
-        conn.commit()
+
+    migrate()
+
+# --- Миграции схемы ---
+# Шаги применяются по порядку и ровно один раз; номер последнего примененного шага хранится в PRAGMA user_version.
+# Новые изменения схемы добавляются только в конец списка MIGRATIONS.
+
+def _columns(conn, table):
+    return [column[1] for column in conn.execute(f"PRAGMA table_info({table})")]
+
+def _migration_result_columns(conn):
+    """Колонки full_prompt, resp_time и status в results (базы ранних версий)."""
+    columns = _columns(conn, "results")
+    if 'full_prompt' not in columns:
+        conn.execute("ALTER TABLE results ADD COLUMN full_prompt TEXT")
+    if 'resp_time' not in columns:
+        conn.execute("ALTER TABLE results ADD COLUMN resp_time REAL")
+    if 'status' not in columns:
+        conn.execute("ALTER TABLE results ADD COLUMN status TEXT")
+
+def _migration_result_indexes(conn):
+    """Индексы для метрик по моделям и выборок истории по дате."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_results_model_status_time ON results(model_name, status, resp_time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_results_prompt_date ON results(prompt_id, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_results_date ON results(date)")
+
+def _migration_prompt_hash(conn):
+    """Колонка prompt_hash для поиска дубликатов промптов без сравнения полного текста."""
+    for _, table in PROMPT_SLOTS:
+        if 'prompt_hash' not in _columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN prompt_hash TEXT")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_hash ON {table}(prompt_hash)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_date ON {table}(date)")
+
+def _migration_prompt_hash_unique(conn):
+    """Заполнение prompt_hash у старых строк, слияние дубликатов и уникальный индекс по хешу."""
+    result_tables = {"prompts": "results", "prompts2": "results2", "prompts3": "results3"}
+    for _, table in PROMPT_SLOTS:
+        rows = conn.execute(f"SELECT id, prompt FROM {table} WHERE prompt_hash IS NULL AND prompt IS NOT NULL").fetchall()
+        conn.executemany(f"UPDATE {table} SET prompt_hash = ? WHERE id = ?",
+                         [(prompt_hash(text), row_id) for row_id, text in rows])
+
+        # Из дубликатов оставляем самую свежую запись (как раньше возвращал get_prompt_id) и перепривязываем результаты
+        duplicates = conn.execute(f"""
+            SELECT d.id, (SELECT k.id FROM {table} k WHERE k.prompt_hash = d.prompt_hash ORDER BY k.date DESC, k.id DESC LIMIT 1)
+            FROM {table} d
+            WHERE d.prompt_hash IN (SELECT prompt_hash FROM {table} WHERE prompt_hash IS NOT NULL GROUP BY prompt_hash HAVING COUNT(*) > 1)
+        """).fetchall()
+        moves = [(keep_id, dup_id) for dup_id, keep_id in duplicates if dup_id != keep_id]
+        conn.executemany(f"UPDATE {result_tables[table]} SET prompt_id = ? WHERE prompt_id = ?", moves)
+        conn.executemany(f"DELETE FROM {table} WHERE id = ?", [(dup_id,) for _, dup_id in moves])
+
+        conn.execute(f"DROP INDEX IF EXISTS idx_{table}_hash")
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{table}_hash ON {table}(prompt_hash)")
+
+# Вклад одной строки results в агрегаты model_stats (ROW = NEW или OLD)
+_STATS_DELTA = """
+    total = total {op} 1,
+    timed = timed {op} (IFNULL({row}.resp_time, 0) > 0),
+    sum_time = sum_time {op} (CASE WHEN {row}.resp_time > 0 THEN {row}.resp_time ELSE 0 END),
+    sum_sq_time = sum_sq_time {op} (CASE WHEN {row}.resp_time > 0 THEN {row}.resp_time * {row}.resp_time ELSE 0 END),
+    errors = errors {op} (IFNULL({row}.resp_time, 0) > 0 AND IFNULL({row}.status, '') LIKE 'Error%')
+"""
+
+def _migration_model_stats(conn):
+    """Таблица model_stats с агрегатами по моделям, поддерживаемая триггерами на results."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS model_stats (
+            model_name TEXT PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            timed INTEGER NOT NULL DEFAULT 0,
+            sum_time REAL NOT NULL DEFAULT 0,
+            sum_sq_time REAL NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            last_seen TEXT
+        )
+    """)
+    # Триггеры, а не код в save_result: в results пишут и QtSql-модели журнала (удаление, правка)
+    add_new = _STATS_DELTA.format(op="+", row="NEW")
+    sub_old = _STATS_DELTA.format(op="-", row="OLD")
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_results_stats_insert AFTER INSERT ON results BEGIN
+            INSERT OR IGNORE INTO model_stats (model_name) VALUES (NEW.model_name);
+            UPDATE model_stats SET {add_new}, last_seen = NEW.date WHERE model_name = NEW.model_name;
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_results_stats_delete AFTER DELETE ON results BEGIN
+            UPDATE model_stats SET {sub_old} WHERE model_name = OLD.model_name;
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_results_stats_update AFTER UPDATE OF model_name, resp_time, status ON results BEGIN
+            UPDATE model_stats SET {sub_old} WHERE model_name = OLD.model_name;
+            INSERT OR IGNORE INTO model_stats (model_name) VALUES (NEW.model_name);
+            UPDATE model_stats SET {add_new} WHERE model_name = NEW.model_name;
+        END
+    """)
+    conn.execute("DELETE FROM model_stats")
+    conn.execute("""
+        INSERT INTO model_stats (model_name, total, timed, sum_time, sum_sq_time, errors, last_seen)
+        SELECT model_name, COUNT(*),
+               SUM(IFNULL(resp_time, 0) > 0),
+               SUM(CASE WHEN resp_time > 0 THEN resp_time ELSE 0 END),
+               SUM(CASE WHEN resp_time > 0 THEN resp_time * resp_time ELSE 0 END),
+               SUM(IFNULL(resp_time, 0) > 0 AND IFNULL(status, '') LIKE 'Error%'),
+               MAX(date)
+        FROM results WHERE model_name IS NOT NULL GROUP BY model_name
+    """)
+
+def _migration_latency_sketches(conn):
+    """Скетчи квантилей задержки по моделям (resp_time, ttft) и колонка ttft в results."""
+    if 'ttft' not in _columns(conn, "results"):
+        conn.execute("ALTER TABLE results ADD COLUMN ttft REAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS latency_sketches (
+            model_name TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (model_name, metric)
+        )
+    """)
+    rows = conn.execute("SELECT model_name, resp_time, ttft FROM results WHERE resp_time > 0").fetchall()
+    _update_sketches(conn, rows)
+
+def _migration_response_cache(conn):
+    """Локальный кеш ответов моделей с TTL и LRU-вытеснением по размеру."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY,
+            model_name TEXT,
+            payload TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_access ON response_cache(last_access)")
+
+# Полнотекстовые индексы: (FTS-таблица, исходная таблица, индексируемые колонки)
+FTS_INDEXES = (
+    ("results_fts", "results", ("response", "full_prompt")),
+    ("prompts_fts", "prompts", ("prompt",)),
+    ("prompts2_fts", "prompts2", ("prompt",)),
+    ("prompts3_fts", "prompts3", ("prompt",)),
+    ("notes_fts", "notes", ("title", "content", "tag")),
+)
+
+def _fts5_supported(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp._fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def _fts_missing(conn):
+    return any(not _fts_ready(conn, fts) for fts, _, _ in FTS_INDEXES)
+
+def _migration_fts(conn):
+    """
+    Полнотекстовые индексы FTS5 по результатам, промптам и заметкам, синхронизируемые триггерами.
+    Без FTS5 шаг ничего не создает; индексы строятся при первом запуске с FTS5 (см. migrate).
+    """
+    if not _fts5_supported(conn):
+        logger.warning("SQLite is built without FTS5, full-text search falls back to LIKE")
+        return
+    for fts, table, columns in FTS_INDEXES:
+        cols = ", ".join(columns)
+        new_values = ", ".join(f"NEW.{c}" for c in columns)
+        old_values = ", ".join(f"OLD.{c}" for c in columns)
+        # External content: текст хранится только в исходной таблице, индекс ссылается на ее id
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                {cols}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts} (rowid, {cols}) VALUES (NEW.id, {new_values});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', OLD.id, {old_values});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_update AFTER UPDATE OF {cols} ON {table} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', OLD.id, {old_values});
+                INSERT INTO {fts} (rowid, {cols}) VALUES (NEW.id, {new_values});
+            END
+        """)
+        conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+USAGE_COLUMNS = ("prompt_tokens", "completion_tokens", "reasoning_tokens", "cached_tokens")
+
+def _migration_usage(conn):
+    """Колонки расхода токенов, стоимости и ID запуска в results; локальная таблица цен model_prices."""
+    existing = _columns(conn, "results")
+    for column, sql_type in [(c, "INTEGER") for c in USAGE_COLUMNS] + [("cost", "REAL"), ("run_id", "TEXT")]:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE results ADD COLUMN {column} {sql_type}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_results_run ON results(run_id)")
+    # Цены в долларах за миллион токенов; cached - цена токенов промпта из кеша (NULL - как обычный промпт)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS model_prices (
+            model_name TEXT PRIMARY KEY,
+            prompt_per_mtok REAL NOT NULL DEFAULT 0,
+            completion_per_mtok REAL NOT NULL DEFAULT 0,
+            cached_per_mtok REAL
+        )
+    """)
+
+def _migration_stats_last_seen(conn):
+    """Триггеры model_stats пересчитывают last_seen при удалении и переименовании результатов."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_results_model_date ON results(model_name, date)")
+    add_new = _STATS_DELTA.format(op="+", row="NEW")
+    sub_old = _STATS_DELTA.format(op="-", row="OLD")
+    last_seen = "last_seen = (SELECT MAX(date) FROM results WHERE model_name = {row}.model_name)"
+    conn.execute("DROP TRIGGER IF EXISTS trg_results_stats_delete")
+    conn.execute(f"""
+        CREATE TRIGGER trg_results_stats_delete AFTER DELETE ON results BEGIN
+            UPDATE model_stats SET {sub_old}, {last_seen.format(row="OLD")} WHERE model_name = OLD.model_name;
+        END
+    """)
+    conn.execute("DROP TRIGGER IF EXISTS trg_results_stats_update")
+    conn.execute(f"""
+        CREATE TRIGGER trg_results_stats_update AFTER UPDATE OF model_name, resp_time, status ON results BEGIN
+            UPDATE model_stats SET {sub_old}, {last_seen.format(row="OLD")} WHERE model_name = OLD.model_name;
+            INSERT OR IGNORE INTO model_stats (model_name) VALUES (NEW.model_name);
+            UPDATE model_stats SET {add_new}, {last_seen.format(row="NEW")} WHERE model_name = NEW.model_name;
+        END
+    """)
+    conn.execute("UPDATE model_stats SET last_seen = (SELECT MAX(date) FROM results WHERE model_name = model_stats.model_name)")
+
+MIGRATIONS = [
+    _migration_result_columns,
+    _migration_result_indexes,
+    _migration_prompt_hash,
+    _migration_prompt_hash_unique,
+    _migration_model_stats,
+    _migration_latency_sketches,
+    _migration_response_cache,
+    _migration_fts,
+    _migration_usage,
+    _migration_stats_last_seen,
+]
+
+def migrate():
+    """Применяет недостающие шаги миграции, каждый в своей транзакции."""
+    conn = get_connection()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for step, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with transaction():
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {step}")
+        logger.info(f"DB migrated to version {step}: {migration.__doc__}")
+    # Шаг FTS мог пройти без FTS5 (номер версии линейный, следующие шаги его не ждут):
+    # индексы достраиваются, как только SQLite с FTS5 становится доступен
+    if version >= MIGRATIONS.index(_migration_fts) + 1 and _fts_missing(conn) and _fts5_supported(conn):
+        with transaction():
+            _migration_fts(conn)
+        logger.info("Full-text indexes built")
+
+def prompt_hash(text):
+    """Стабильный хеш содержимого промпта (BLAKE2b, 128 бит)."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
 
 # --- CRUD для моделей ---
 
 def get_models(only_active=False):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        if only_active:
-            cursor.execute("SELECT name, api_url, api_id, is_active FROM models WHERE is_active = 1")
-        else:
-            cursor.execute("SELECT name, api_url, api_id, is_active FROM models")
-        return cursor.fetchall()
+    conn = get_connection()
+    cursor = conn.cursor()
+    if only_active:
+        cursor.execute("SELECT name, api_url, api_id, is_active FROM models WHERE is_active = 1")
+    else:
+        cursor.execute("SELECT name, api_url, api_id, is_active FROM models")
+    return cursor.fetchall()
 
 def add_model(name, api_url, api_id, is_active=1):
-    with get_connection() as conn:
+    with transaction() as conn:
         cursor = conn.cursor()
         cursor.execute("INSERT OR REPLACE INTO models (name, api_url, api_id, is_active) VALUES (?, ?, ?, ?)",
                        (name, api_url, api_id, is_active))
-        conn.commit()
 
 def delete_model(name):
-    with get_connection() as conn:
+    with transaction() as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM models WHERE name = ?", (name,))
-        conn.commit()
 
 # --- CRUD для промтов ---
 
+def _upsert_prompt(conn, table, text, date_str, tags=""):
+    # Один индексированный запрос: вставка либо ID уже существующей строки с тем же хешем.
+    # Повторно сохраненный промпт поднимается наверх истории (новая дата), новые теги заменяют старые
+    return conn.execute(f"""
+        INSERT INTO {table} (date, prompt, tags, prompt_hash) VALUES (?, ?, ?, ?)
+        ON CONFLICT(prompt_hash) DO UPDATE SET
+            date = excluded.date,
+            tags = CASE WHEN excluded.tags != '' THEN excluded.tags ELSE {table}.tags END
+        RETURNING id
+    """, (date_str, text, tags, prompt_hash(text))).fetchone()[0]
+
 def add_prompt(text, tags="", table="prompts"):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        date_str = datetime.now().isoformat()
-        cursor.execute(f"INSERT INTO {table} (date, prompt, tags) VALUES (?, ?, ?)", (date_str, text, tags))
-        conn.commit()
-        return cursor.lastrowid
+    """
+    Добавляет промпт в таблицу слота. Для уже сохраненного текста возвращает существующий ID,
+    обновив дату (и теги, если они заданы).
+    """
+    with transaction() as conn:
+        return _upsert_prompt(conn, table, text, datetime.now().isoformat(), tags)
 
 def get_prompts(table="prompts"):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT id, date, prompt, tags FROM {table} ORDER BY date DESC")
-        return cursor.fetchall()
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT id, date, prompt, tags FROM {table} ORDER BY date DESC")
+    return cursor.fetchall()
 
 def delete_prompt(prompt_id, table="prompts"):
-    with get_connection() as conn:
+    with transaction() as conn:
         cursor = conn.cursor()
         cursor.execute(f"DELETE FROM {table} WHERE id = ?", (prompt_id,))
-        conn.commit()
 
 def get_prompt_id(text, table="prompts"):
     """Возвращает ID промпта, если он уже есть в базе."""
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT id FROM {table} WHERE prompt = ? ORDER BY date DESC LIMIT 1", (text,))
-        row = cursor.fetchone()
-        return row[0] if row else None
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT id FROM {table} WHERE prompt_hash = ?", (prompt_hash(text),))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _upsert_prompts(conn, table, texts, date_str):
+    """Находит или добавляет пачку текстов промптов в таблицу слота, возвращает {текст: id}."""
+    return {text: _upsert_prompt(conn, table, text, date_str) for text in texts}
 
 # --- Сохранение результатов ---
 
-def save_result(prompt_id, model_name, response, table="results", full_prompt="", resp_time=0.0, status="Success"):
-    with get_connection() as conn:
+# Слоты тройного промпта и их таблицы истории
+PROMPT_SLOTS = (("p1", "prompts"), ("p2", "prompts2"), ("p3", "prompts3"))
+
+def save_results_batch(items):
+    """
+    Сохраняет пачку результатов одной транзакцией (один fsync на всю пачку).
+    items - словари с ключами p1/p2/p3, model, response, resp_time, status, ttft,
+    а также (необязательно) счетчики токенов, provider_cost и run_id.
+    Части промпта раскладываются по таблицам prompts/prompts2/prompts3, результат привязывается к P1.
+    Возвращает ID вставленных строк results в порядке items.
+    """
+    if not items:
+        return []
+    date_str = datetime.now().isoformat()
+    with transaction() as conn:
+        slot_ids = {}
+        for key, table in PROMPT_SLOTS:
+            texts = list(dict.fromkeys(item.get(key) for item in items if item.get(key)))
+            slot_ids[key] = _upsert_prompts(conn, table, texts, date_str)
+
+        rows = []
+        for item in items:
+            parts = [item.get(key, "") for key, _ in PROMPT_SLOTS]
+            # Если модели ушел переставленный промпт (кеш префикса), в журнал пишется именно он
+            full_prompt = item.get('full_prompt') or "\n\n".join([p for p in parts if p])
+            p1_id = slot_ids["p1"].get(parts[0]) or 0
+            rows.append((p1_id, item['model'], item['response'], date_str, full_prompt,
+                         item.get('resp_time', 0.0), item.get('status', 'Success'), item.get('ttft'),
+                         *(item.get(column) for column in USAGE_COLUMNS), item.get('provider_cost'), item.get('run_id')))
+
+        # Под BEGIN IMMEDIATE других писателей нет, поэтому все id больше прежнего максимума - наши
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM results").fetchone()[0]
+        conn.executemany(f"""
+            INSERT INTO results (prompt_id, model_name, response, date, full_prompt, resp_time, status, ttft,
+                                 {", ".join(USAGE_COLUMNS)}, cost, run_id)
+            VALUES ({", ".join("?" * 14)})
+        """, rows)
+        _update_sketches(conn, [(row[1], row[5], row[7]) for row in rows])
+        return [row[0] for row in conn.execute("SELECT id FROM results WHERE id > ? ORDER BY id", (last_id,))]
+
+def _update_sketches(conn, samples, remove=False):
+    """
+    Добавляет замеры (model_name, resp_time, ttft) в скетчи квантилей одной операцией на модель
+    (remove=True - убирает их, при удалении результатов).
+    """
+    by_key = {}
+    for model_name, resp_time, ttft in samples:
+        for metric, value in (("resp_time", resp_time), ("ttft", ttft)):
+            if value and value > 0:
+                by_key.setdefault((model_name, metric), []).append(value)
+    for (model_name, metric), values in by_key.items():
+        row = conn.execute("SELECT data FROM latency_sketches WHERE model_name = ? AND metric = ?",
+                           (model_name, metric)).fetchone()
+        sketch = LatencySketch.from_json(row[0] if row else None)
+        for value in values:
+            if remove:
+                sketch.remove(value)
+            else:
+                sketch.add(value)
+        if not sketch.count:
+            conn.execute("DELETE FROM latency_sketches WHERE model_name = ? AND metric = ?", (model_name, metric))
+            continue
+        conn.execute("INSERT OR REPLACE INTO latency_sketches (model_name, metric, data) VALUES (?, ?, ?)",
+                     (model_name, metric, sketch.to_json()))
+
+def save_result(prompt_id, model_name, response, table="results", full_prompt="", resp_time=0.0, status="Success", ttft=None):
+    with transaction() as conn:
         cursor = conn.cursor()
         date_str = datetime.now().isoformat()
         if table == "results":
-            cursor.execute(f"INSERT INTO {table} (prompt_id, model_name, response, date, full_prompt, resp_time, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                           (prompt_id, model_name, response, date_str, full_prompt, resp_time, status))
+            cursor.execute(f"INSERT INTO {table} (prompt_id, model_name, response, date, full_prompt, resp_time, status, ttft) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           (prompt_id, model_name, response, date_str, full_prompt, resp_time, status, ttft))
+            _update_sketches(conn, [(model_name, resp_time, ttft)])
         else:
             cursor.execute(f"INSERT INTO {table} (prompt_id, model_name, response, date) VALUES (?, ?, ?, ?)",
                            (prompt_id, model_name, response, date_str))
-        conn.commit()
+
+def _stats_metrics(timed, sum_time, sum_sq_time, errors):
+    avg = sum_time / timed if timed else 0.0
+    std = math.sqrt(max(sum_sq_time / timed - avg * avg, 0.0)) if timed else 0.0
+    return {"avg_time": round(avg, 2), "std_time": round(std, 2), "errors": errors, "runs": timed}
 
 def get_model_metrics(model_name):
     """Возвращает (среднее_время, количество_ошибок) для модели."""
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT AVG(resp_time), COUNT(*) FILTER (WHERE status LIKE 'Error%')
-            FROM results 
-            WHERE model_name = ? AND resp_time > 0
-        """, (model_name,))
-        res = cursor.fetchone()
-        return (round(res[0], 2) if res[0] else 0.0, res[1] or 0)
+    conn = get_connection()
+    row = conn.execute("SELECT timed, sum_time, sum_sq_time, errors FROM model_stats WHERE model_name = ?",
+                       (model_name,)).fetchone()
+    if not row or not row[0]:
+        return (0.0, 0)
+    metrics = _stats_metrics(*row)
+    return (metrics["avg_time"], metrics["errors"])
+
+def get_latency_percentiles():
+    """
+    Возвращает {модель: {"p50", "p90", "p99", "ttft_p50", ..., "histogram"}} из скетчей задержки.
+    histogram - число ответов по интервалам времени (LatencySketch.histogram).
+    """
+    result = {}
+    for model_name, metric, data in get_connection().execute("SELECT model_name, metric, data FROM latency_sketches"):
+        prefix = "" if metric == "resp_time" else f"{metric}_"
+        sketch = LatencySketch.from_json(data)
+        model_metrics = result.setdefault(model_name, {})
+        for name, value in sketch.percentiles().items():
+            model_metrics[prefix + name] = value
+        if metric == "resp_time":
+            model_metrics["histogram"] = sketch.histogram()
+    return result
 
 def get_all_metrics():
-    """Возвращает метрики для всех моделей."""
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT model_name, AVG(resp_time), COUNT(*) FILTER (WHERE status LIKE 'Error%')
-            FROM results 
-            WHERE resp_time > 0
-            GROUP BY model_name
-        """)
-        return {row[0]: {"avg_time": round(row[1], 2), "errors": row[2]} for row in cursor.fetchall()}
+    """Возвращает метрики для всех моделей (из агрегатов model_stats и скетчей, без прохода по results)."""
+    conn = get_connection()
+    cursor = conn.execute("SELECT model_name, timed, sum_time, sum_sq_time, errors FROM model_stats WHERE timed > 0")
+    metrics = {row[0]: _stats_metrics(*row[1:]) for row in cursor.fetchall()}
+    for model_name, percentiles in get_latency_percentiles().items():
+        if model_name in metrics:
+            metrics[model_name].update(percentiles)
+    return metrics
 
 def get_model_popularity_rating(limit=5):
     """Возвращает список самых используемых моделей на основе сохраненных результатов."""
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT model_name, COUNT(*) as cnt 
-            FROM results 
-            GROUP BY model_name 
-            ORDER BY cnt DESC 
-            LIMIT ?
-        """, (limit,))
-        return cursor.fetchall()
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT model_name, total
+        FROM model_stats 
+        WHERE total > 0
+        ORDER BY total DESC 
+        LIMIT ?
+    """, (limit,))
+    return cursor.fetchall()
 
 def get_results(prompt_id=None):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        if prompt_id:
-            cursor.execute("SELECT id, prompt_id, model_name, response, date, full_prompt FROM results WHERE prompt_id = ? ORDER BY date DESC", (prompt_id,))
-        else:
-            cursor.execute("SELECT id, prompt_id, model_name, response, date, full_prompt FROM results ORDER BY date DESC")
-        return cursor.fetchall()
+    conn = get_connection()
+    cursor = conn.cursor()
+    if prompt_id:
+        cursor.execute("SELECT id, prompt_id, model_name, response, date, full_prompt FROM results WHERE prompt_id = ? ORDER BY date DESC", (prompt_id,))
+    else:
+        cursor.execute("SELECT id, prompt_id, model_name, response, date, full_prompt FROM results ORDER BY date DESC")
+    return cursor.fetchall()
+
+# --- Расход токенов и стоимость ---
+
+# Стоимость строки: сообщенная провайдером, иначе по локальной таблице цен (токены из кеша - по своей цене)
+_COST_SQL = """COALESCE(r.cost, (
+    (COALESCE(r.prompt_tokens, 0) - COALESCE(r.cached_tokens, 0)) * p.prompt_per_mtok
+    + COALESCE(r.cached_tokens, 0) * COALESCE(p.cached_per_mtok, p.prompt_per_mtok)
+    + COALESCE(r.completion_tokens, 0) * p.completion_per_mtok) / 1000000.0)"""
+
+def set_model_price(model_name, prompt_per_mtok, completion_per_mtok, cached_per_mtok=None):
+    with transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO model_prices (model_name, prompt_per_mtok, completion_per_mtok, cached_per_mtok) "
+                     "VALUES (?, ?, ?, ?)", (model_name, prompt_per_mtok, completion_per_mtok, cached_per_mtok))
+
+def get_model_price(model_name):
+    """(prompt, completion, cached) в $ за миллион токенов или None, если цена не задана."""
+    return get_connection().execute("SELECT prompt_per_mtok, completion_per_mtok, cached_per_mtok FROM model_prices "
+                                    "WHERE model_name = ?", (model_name,)).fetchone()
+
+def estimate_cost(model_name, usage):
+    """Стоимость одного ответа по таблице цен (usage - словарь счетчиков токенов); None, если цены нет."""
+    price = get_model_price(model_name)
+    if price is None or usage.get("prompt_tokens") is None and usage.get("completion_tokens") is None:
+        return None
+    prompt_price, completion_price, cached_price = price
+    cached = usage.get("cached_tokens") or 0
+    prompt = (usage.get("prompt_tokens") or 0) - cached
+    completion = usage.get("completion_tokens") or 0
+    return (prompt * prompt_price + cached * (cached_price if cached_price is not None else prompt_price)
+            + completion * completion_price) / 1000000.0
+
+def _usage_summary(group_expr, order, limit, where=""):
+    rows = get_connection().execute(f"""
+        SELECT {group_expr} AS grp, COUNT(*),
+               SUM(r.prompt_tokens), SUM(r.completion_tokens), SUM(r.reasoning_tokens), SUM(r.cached_tokens),
+               SUM({_COST_SQL}),
+               SUM(CASE WHEN r.completion_tokens > 0 AND r.resp_time > 0 THEN r.completion_tokens END)
+                   / SUM(CASE WHEN r.completion_tokens > 0 AND r.resp_time > 0 THEN r.resp_time END),
+               MIN(r.date)
+        FROM results r LEFT JOIN model_prices p ON p.model_name = r.model_name
+        {where}
+        GROUP BY grp ORDER BY {order} LIMIT ?
+    """, (limit,)).fetchall()
+    keys = ("key", "results", "prompt_tokens", "completion_tokens", "reasoning_tokens", "cached_tokens",
+            "cost", "tokens_per_sec", "first_date")
+    return [dict(zip(keys, row)) for row in rows]
+
+def get_usage_by_run(limit=20):
+    """Расход по запускам (одна рассылка промпта), от последних к первым."""
+    return _usage_summary("r.run_id", "MIN(r.date) DESC", limit, "WHERE r.run_id IS NOT NULL")
+
+def get_usage_by_model(limit=50):
+    """Расход и пропускная способность (токенов/с) по моделям, от самых дорогих."""
+    return _usage_summary("r.model_name", "SUM(" + _COST_SQL + ") DESC, COUNT(*) DESC", limit)
+
+def get_usage_by_day(limit=30):
+    """Расход по дням (дата ISO без времени), от последних к первым."""
+    return _usage_summary("substr(r.date, 1, 10)", "grp DESC", limit)
+
+JOURNAL_PREVIEW_CHARS = 300
+
+def get_results_page(limit=200, before=None):
+    """
+    Страница журнала результатов, от новых к старым. Keyset-пагинация по (date, id): before - ключ
+    последней строки предыдущей страницы. Ответ и промпт обрезаны до превью; полный текст - get_result_response.
+    """
+    sql = ("SELECT id, prompt_id, model_name, substr(response, 1, ?), date, substr(full_prompt, 1, ?) "
+           "FROM results")
+    params = [JOURNAL_PREVIEW_CHARS, JOURNAL_PREVIEW_CHARS]
+    if before is not None:
+        sql += " WHERE (date, id) < (?, ?)"
+        params.extend(before)
+    sql += " ORDER BY date DESC, id DESC LIMIT ?"
+    params.append(limit)
+    return get_connection().execute(sql, params).fetchall()
+
+def get_result_response(result_id):
+    """Полный ответ сохраненного результата: (model_name, response) или None."""
+    return get_connection().execute("SELECT model_name, response FROM results WHERE id = ?",
+                                    (result_id,)).fetchone()
 
 def delete_result(result_id):
-    with get_connection() as conn:
+    with transaction() as conn:
         cursor = conn.cursor()
+        # model_stats обновляет триггер, скетчи задержки - здесь же, в той же транзакции
+        row = cursor.execute("SELECT model_name, resp_time, ttft FROM results WHERE id = ?", (result_id,)).fetchone()
         cursor.execute("DELETE FROM results WHERE id = ?", (result_id,))
-        conn.commit()
+        if row:
+            _update_sketches(conn, [row], remove=True)
+
+# --- Полнотекстовый поиск ---
+
+HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE = "«", "»"
+
+def fts_query(text):
+    """
+    Пользовательский ввод -> безопасное выражение FTS5: каждое слово в кавычках как префикс, все слова обязательны.
+    Операторы и спецсимволы FTS5 из ввода не интерпретируются. Пустая строка, если слов нет.
+    """
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text))
+
+def like_pattern(text):
+    """Шаблон LIKE '%текст%' (с ESCAPE '\\'): %, _ и \\ из ввода ищутся буквально."""
+    escaped = text.strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def _fts_ready(conn, fts):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,)).fetchone() is not None
+
+def search_results(query, limit=200, offset=0):
+    """
+    Поиск по сохраненным результатам для журнала: строки в формате get_results_page, самые релевантные (bm25)
+    первыми; в колонках ответа и промпта - фрагменты с подсвеченными совпадениями.
+    """
+    conn = get_connection()
+    match = fts_query(query)
+    if not match:
+        return []
+    if _fts_ready(conn, "results_fts"):
+        return conn.execute(f"""
+            SELECT r.id, r.prompt_id, r.model_name,
+                   snippet(results_fts, 0, '{HIGHLIGHT_OPEN}', '{HIGHLIGHT_CLOSE}', '…', 24),
+                   r.date,
+                   snippet(results_fts, 1, '{HIGHLIGHT_OPEN}', '{HIGHLIGHT_CLOSE}', '…', 16)
+            FROM results_fts JOIN results r ON r.id = results_fts.rowid
+            WHERE results_fts MATCH ?
+            ORDER BY bm25(results_fts) LIMIT ? OFFSET ?
+        """, (match, limit, offset)).fetchall()
+    pattern = like_pattern(query)
+    return conn.execute("""
+        SELECT id, prompt_id, model_name, substr(response, 1, ?), date, substr(full_prompt, 1, ?) FROM results
+        WHERE model_name LIKE ? ESCAPE '\\' OR response LIKE ? ESCAPE '\\' OR full_prompt LIKE ? ESCAPE '\\'
+        ORDER BY date DESC, id DESC LIMIT ? OFFSET ?
+    """, (JOURNAL_PREVIEW_CHARS, JOURNAL_PREVIEW_CHARS, pattern, pattern, pattern, limit, offset)).fetchall()
+
+def search_prompts(query, table="prompts", limit=50):
+    """Поиск по истории промптов слота: (id, date, prompt, фрагмент) по релевантности."""
+    conn = get_connection()
+    fts = f"{table}_fts"
+    match = fts_query(query)
+    if not match:
+        return []
+    if _fts_ready(conn, fts):
+        return conn.execute(f"""
+            SELECT p.id, p.date, p.prompt, snippet({fts}, 0, '{HIGHLIGHT_OPEN}', '{HIGHLIGHT_CLOSE}', '…', 16)
+            FROM {fts} JOIN {table} p ON p.id = {fts}.rowid
+            WHERE {fts} MATCH ? ORDER BY bm25({fts}) LIMIT ?
+        """, (match, limit)).fetchall()
+    return conn.execute(f"SELECT id, date, prompt, substr(prompt, 1, 200) FROM {table} WHERE prompt LIKE ? ESCAPE '\\' "
+                        f"ORDER BY date DESC LIMIT ?", (like_pattern(query), limit)).fetchall()
+
+def search_notes(query, limit=500):
+    """
+    Заметки, подходящие под запрос: (id, фрагмент) от самых релевантных (совпадения в заголовке весят больше).
+    Фрагмент берется из лучше всего совпавшей колонки, совпадения подсвечены.
+    """
+    conn = get_connection()
+    match = fts_query(query)
+    if not match:
+        return []
+    if _fts_ready(conn, "notes_fts"):
+        return conn.execute(f"""
+            SELECT rowid, snippet(notes_fts, -1, '{HIGHLIGHT_OPEN}', '{HIGHLIGHT_CLOSE}', '…', 16)
+            FROM notes_fts WHERE notes_fts MATCH ?
+            ORDER BY bm25(notes_fts, 3.0, 1.0, 2.0) LIMIT ?
+        """, (match, limit)).fetchall()
+    pattern = like_pattern(query)
+    return conn.execute("SELECT id, substr(content, 1, 200) FROM notes "
+                        "WHERE content LIKE ? ESCAPE '\\' OR title LIKE ? ESCAPE '\\' OR tag LIKE ? ESCAPE '\\' LIMIT ?",
+                        (pattern, pattern, pattern, limit)).fetchall()
+
+# --- Кеш ответов ---
+
+def get_cached_response(cache_key, ttl):
+    """
+    Возвращает (результат, просрочен): результат - сохраненный dict или None, если записи нет
+    или она старше ttl секунд (тогда просрочен=True). Только читает: отметку last_access
+    и удаление просроченной записи вызывающий код передает в поток записи
+    (touch_cached_response / expire_cached_response).
+    """
+    row = get_connection().execute("SELECT payload, created FROM response_cache WHERE cache_key = ?",
+                                   (cache_key,)).fetchone()
+    if not row:
+        return None, False
+    if time.time() - row[1] > ttl:
+        return None, True
+    return json.loads(row[0]), False
+
+def touch_cached_response(cache_key, now=None):
+    """Отмечает использование записи кеша (для вытеснения LRU)."""
+    with transaction() as conn:
+        conn.execute("UPDATE response_cache SET last_access = ? WHERE cache_key = ?", (now or time.time(), cache_key))
+
+def expire_cached_response(cache_key, ttl):
+    """Удаляет запись кеша, если она все еще старше ttl секунд (ее могли успеть перезаписать)."""
+    with transaction() as conn:
+        conn.execute("DELETE FROM response_cache WHERE cache_key = ? AND created < ?", (cache_key, time.time() - ttl))
+
+def put_cached_response(cache_key, model_name, result, ttl, max_bytes):
+    """Сохраняет результат в кеш и вытесняет просроченные и давно не использованные записи сверх max_bytes."""
+    payload = json.dumps(result, ensure_ascii=False)
+    now = time.time()
+    with transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO response_cache (cache_key, model_name, payload, size, created, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                     (cache_key, model_name, payload, len(payload.encode("utf-8")), now, now))
+        conn.execute("DELETE FROM response_cache WHERE created < ?", (now - ttl,))
+        # LRU: оставляем самые свежие по last_access, пока суммарный размер не превышает лимит
+        conn.execute("""
+            DELETE FROM response_cache WHERE cache_key IN (
+                SELECT cache_key FROM (
+                    SELECT cache_key, SUM(size) OVER (ORDER BY last_access DESC, cache_key) AS running
+                    FROM response_cache
+                ) WHERE running > ?
+            )
+        """, (max_bytes,))
+
+def clear_response_cache():
+    with transaction() as conn:
+        conn.execute("DELETE FROM response_cache")
 
 # --- Settings Management ---
+# Таблица settings читается один раз и обслуживается из памяти.
+# Запись отложенная: изменения копятся и сбрасываются одной транзакцией после паузы в потоке изменений.
+
+SETTINGS_FLUSH_DELAY = 0.5   # пауза после последнего изменения, сек
+SETTINGS_FLUSH_MAX_WAIT = 3.0  # не дольше этого при непрерывных изменениях
+
+_settings_cache = None
+_settings_dirty = {}
+_settings_lock = threading.RLock()
+_settings_listeners = []
+_settings_event = threading.Event()
+_settings_flusher = None
+_settings_flush_executor = None
+
+def _load_settings():
+    global _settings_cache
+    with _settings_lock:
+        if _settings_cache is None:
+            _settings_cache = dict(get_connection().execute("SELECT key, value FROM settings").fetchall())
+        return _settings_cache
 
 def get_setting(key, default=None):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
-        row = cursor.fetchone()
-        return row[0] if row else default
+    return _load_settings().get(key, default)
 
 def set_setting(key, value):
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
-        conn.commit()
+    """Меняет настройку в памяти, планирует запись на диск и уведомляет подписчиков."""
+    global _settings_flusher
+    value = str(value)
+    with _settings_lock:
+        cache = _load_settings()
+        if cache.get(key) == value:
+            return
+        cache[key] = value
+        _settings_dirty[key] = value
+        if _settings_flusher is None:
+            _settings_flusher = threading.Thread(target=_settings_flush_loop, name="settings-flush", daemon=True)
+            _settings_flusher.start()
+    _settings_event.set()
+
+    for callback in list(_settings_listeners):
+        try:
+            callback(key, value)
+        except Exception as e:
+            logger.error(f"Settings listener failed for {key}: {e}")
+
+def _settings_flush_loop():
+    while True:
+        _settings_event.wait()
+        # Дебаунс: пока значения продолжают меняться (тянут спинбокс), откладываем запись
+        started = time.monotonic()
+        while time.monotonic() - started < SETTINGS_FLUSH_MAX_WAIT:
+            _settings_event.clear()
+            if not _settings_event.wait(SETTINGS_FLUSH_DELAY):
+                break
+        if _settings_flush_executor is not None:
+            _settings_flush_executor(flush_settings)
+            continue
+        try:
+            flush_settings()
+        except sqlite3.Error as e:
+            logger.error(f"Settings flush failed: {e}")
+
+def set_settings_flush_executor(executor):
+    """Задает, где выполнять отложенную запись настроек: executor(flush_settings); None - в потоке дебаунса."""
+    global _settings_flush_executor
+    _settings_flush_executor = executor
+
+def flush_settings():
+    """Записывает накопленные изменения настроек одной транзакцией."""
+    with _settings_lock:
+        if not _settings_dirty:
+            return
+        batch = list(_settings_dirty.items())
+        _settings_dirty.clear()
+    try:
+        with transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", batch)
+    except sqlite3.Error:
+        # Возвращаем в очередь то, что не успели перезаписать более новыми значениями
+        with _settings_lock:
+            for key, value in batch:
+                _settings_dirty.setdefault(key, value)
+        raise
+
+def subscribe_settings(callback):
+    """Подписка на изменения настроек: callback(key, value) вызывается в потоке, изменившем настройку."""
+    if callback not in _settings_listeners:
+        _settings_listeners.append(callback)
+
+def unsubscribe_settings(callback):
+    if callback in _settings_listeners:
+        _settings_listeners.remove(callback)
 
 if __name__ == "__main__":
     init_db()
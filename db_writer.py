@@ -0,0 +1,113 @@
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+import db
+
+logger = logging.getLogger(__name__)
+
+class DbWriter:
+    """
+    Отдельный поток для записи в SQLite, чтобы медленный fsync не подвешивал GUI.
+    Операции выполняются строго в порядке постановки; накопившиеся в очереди коммитятся одной транзакцией,
+    каждая в своем SAVEPOINT, так что ошибка одной операции не откатывает соседние.
+    """
+    MAX_BATCH = 100
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Ставит func(*args, **kwargs) в очередь записи; возвращает concurrent.futures.Future с результатом."""
+        future = concurrent.futures.Future()
+        self._ensure_started()
+        self._queue.put((func, args, kwargs, future))
+        return future
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self._run_batch([op for op in batch if op is not None])
+            if stop:
+                # Соединение этого потока закрывается им самим
+                db.close_connection()
+                break
+
+    def _run_batch(self, batch):
+        done = []
+        try:
+            with db.transaction():
+                for func, args, kwargs, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with db.transaction():
+                            done.append((future, func(*args, **kwargs), None))
+                    except Exception as e:
+                        logger.error(f"DB write {getattr(func, '__name__', func)} failed: {e}")
+                        done.append((future, None, e))
+        except Exception as e:
+            # Не удался сам коммит: ни одна операция пачки не сохранена
+            logger.error(f"DB write batch of {len(batch)} failed: {e}")
+            for future in {f for _, _, _, f in batch}:
+                if future.running():
+                    future.set_exception(e)
+            return
+        # Результаты отдаются только после коммита: дождавшийся вызова код видит данные на диске
+        for future, result, error in done:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def flush(self, timeout=None):
+        """Ждет, пока будут записаны все поставленные ранее операции."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self.submit(lambda: None).result(timeout)
+
+    def stop(self, timeout=10.0):
+        """Дописывает очередь и останавливает поток."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+
+_writer = DbWriter()
+
+def submit(func, *args, **kwargs):
+    return _writer.submit(func, *args, **kwargs)
+
+async def run(func, *args, **kwargs):
+    """Выполняет запись в потоке записи и ожидает ее результат, не блокируя цикл событий."""
+    return await asyncio.wrap_future(_writer.submit(func, *args, **kwargs))
+
+def flush(timeout=None):
+    _writer.flush(timeout)
+
+def shutdown():
+    """Дописывает все отложенные операции (включая настройки) и останавливает поток записи. Вызывается при выходе."""
+    db.set_settings_flush_executor(None)
+    _writer.submit(db.flush_settings)
+    _writer.stop()
+
+# Отложенная запись настроек идет через тот же поток, в общем порядке с остальными записями
+db.set_settings_flush_executor(submit)
@@ -1,17 +1,47 @@
 import sys
 import os
+import html
+import logging
+import threading
 import webbrowser
-import markdown2
+from collections import deque
 from PyQt6.QtWidgets import (QWidget, QVBoxLayout, QTextEdit, QLineEdit, 
                               QPushButton, QHBoxLayout, QCheckBox, QLabel, QScrollArea, QSlider, 
                               QProgressBar, QApplication, QSplitter)
 from PyQt6.QtCore import Qt, pyqtSignal, QThread, QTimer, QEvent
+from PyQt6.QtGui import QTextCursor
 from notes_manager import NotesManager
+import md_render
 from gradio_client import Client
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+
+SPACE_ID = "zai-org/GLM-4.5-Space"
+
+# Один клиент на все сообщения: загрузка конфигурации Space и рукопожатие занимают несколько секунд
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Общий gradio_client.Client для GLM Space (создается при первом обращении, вызывать не из GUI-потока)."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            load_dotenv()
+            hf_token = os.getenv("HF_API_KEY") or os.getenv("HF_TOKEN")
+            _client = Client(SPACE_ID, token=hf_token)
+        return _client
+
+def _last_message(output):
+    # output[0] - history, output[1] - string (usually last msg or status)
+    history = output[0] if output else None
+    return history[-1]['content'] if history else ""
+
 class GradioWorker(QThread):
+    partial = pyqtSignal(str)
     finished = pyqtSignal(str)
+    cancelled = pyqtSignal(str)
     error = pyqtSignal(str)
 
     def __init__(self, msg, sys_prompt, thinking, temperature):
@@ -20,35 +50,72 @@ class GradioWorker(QThread):
         self.sys_prompt = sys_prompt
         self.thinking = thinking
         self.temperature = temperature
+        self.job = None
+        self.is_cancelled = False
 
     def run(self):
         try:
-            load_dotenv()
-            hf_token = os.getenv("HF_API_KEY") or os.getenv("HF_TOKEN")
-            client = Client("zai-org/GLM-4.5-Space", token=hf_token)
-            
-            result = client.predict(
+            client = get_client()
+            self.job = client.submit(
                 msg=self.msg,
                 sys_prompt=self.sys_prompt,
                 thinking_enabled=self.thinking,
                 temperature=self.temperature,
                 api_name="/chat_wrapper"
             )
-            # result[0] - history, result[1] - string (usually last msg or status)
-            # We want to extract the last response from history
-            history = result[0]
-            if history:
-                last_msg = history[-1]['content']
-                self.finished.emit(last_msg)
+            # Промежуточные выходы генератора приходят по мере генерации ответа
+            text = ""
+            for output in self.job:
+                text = _last_message(output) or text
+                self.partial.emit(text)
+            if self.is_cancelled:
+                self.cancelled.emit(text)
+                return
+            outputs = self.job.outputs()
+            text = _last_message(outputs[-1]) if outputs else text
+            self.finished.emit(text or "No response content.")
+        except Exception as e:
+            if self.is_cancelled:
+                self.cancelled.emit("")
             else:
-                self.finished.emit("No response content.")
+                self.error.emit(str(e))
+
+    def cancel(self):
+        self.is_cancelled = True
+        if self.job is not None:
+            self.job.cancel()
+
+class ClientTask(QThread):
+    """Фоновый вызов общего клиента (прогрев, сброс контекста), чтобы не ждать сеть в GUI-потоке."""
+    def __init__(self, func):
+        super().__init__()
+        self.func = func
+
+    def run(self):
+        try:
+            self.func(get_client())
         except Exception as e:
-            self.error.emit(str(e))
+            logger.error(f"GLM Space call failed: {e}")
+
+CHAT_MARKDOWN_EXTRAS = ("fenced-code-blocks", "tables", "break-on-newline", "blockquote")
 
 class GLMChatWindow(QWidget):
     def __init__(self):
         super().__init__()
+        # Сообщения в порядке поступления; ответ модели ждет здесь своего HTML из сервиса рендера
+        self.pending_messages = deque()
+        self.worker = None
+        self.stream_start = None # Позиция в документе чата, с которой идет потоковый ответ
+        self.stream_text = ""
+        self.chat_generation = 0 # Растет при сбросе чата: запоздавший рендер старого ответа игнорируется
+        self.background_tasks = []
         self.init_ui()
+        self.stream_timer = QTimer(self)
+        self.stream_timer.setSingleShot(True)
+        self.stream_timer.setInterval(100)
+        self.stream_timer.timeout.connect(self.render_stream)
+        # Клиент Space создается заранее, пока пользователь набирает первое сообщение
+        self.run_client_task(lambda client: None)
 
     def init_ui(self):
         self.setWindowTitle("GLM-4.5 Air - Special Chat")
@@ -343,6 +410,11 @@ class GLMChatWindow(QWidget):
             }
         """)
         
+        self.btn_stop = QPushButton("Stop")
+        self.btn_stop.setToolTip("Cancel the answer that is being generated")
+        self.btn_stop.setVisible(False)
+        self.btn_stop.clicked.connect(self.stop_generation)
+        
         self.btn_reset = QPushButton("Reset")
         self.btn_reset.clicked.connect(self.reset_chat)
         self.btn_reset.setStyleSheet("""
@@ -414,6 +486,7 @@ class GLMChatWindow(QWidget):
 
         bottom_buttons_layout.addStretch()
         bottom_buttons_layout.addWidget(self.btn_send)
+        bottom_buttons_layout.addWidget(self.btn_stop)
         bottom_buttons_layout.addWidget(self.btn_reset)
         bottom_buttons_layout.addWidget(btn_notes)
         bottom_buttons_layout.addWidget(btn_web)
@@ -451,21 +524,32 @@ class GLMChatWindow(QWidget):
         bot_color = "#006400"  # Темно-зеленый для бота
         role_color = user_color if role == "User" else bot_color
         
+        entry = {"html": None}
+        self.pending_messages.append(entry)
         if role == "GLM-4.5":
-            try:
-                # Рендерим Markdown в HTML
-                html_body = markdown2.markdown(text, extras=["fenced-code-blocks", "tables", "break-on-newline", "blockquote"])
-                msg_html = f"<div style='margin-bottom: 12px; border-bottom: 1px dotted #ccc; padding-bottom: 5px;'>" \
-                           f"<b style='color: {role_color};'>{role}:</b><br>{html_body}</div>"
-                self.chat_display.append(msg_html)
-            except Exception as e:
-                self.chat_display.append(f"<b style='color: {role_color};'>{role}:</b> {text}<br>")
+            def on_rendered(html_body, error):
+                if error:
+                    entry["html"] = f"<b style='color: {role_color};'>{role}:</b> {text}<br>"
+                else:
+                    entry["html"] = f"<div style='margin-bottom: 12px; border-bottom: 1px dotted #ccc; padding-bottom: 5px;'>" \
+                                    f"<b style='color: {role_color};'>{role}:</b><br>{html_body}</div>"
+                self.flush_messages()
+            # Markdown рендерится в фоновом потоке (или берется из кеша)
+            md_render.get_service().render(text, on_rendered, CHAT_MARKDOWN_EXTRAS)
         else:
             # Для пользователя или системы просто сохраняем переносы
             safe_text = text.replace('\n', '<br>').replace(' ', '&nbsp;')
-            msg_html = f"<div style='margin-bottom: 10px; border-bottom: 1px solid #ddd; padding-bottom: 3px;'>" \
-                       f"<b style='color: {role_color};'>{role}:</b><br>{safe_text}</div>"
-            self.chat_display.append(msg_html)
+            entry["html"] = f"<div style='margin-bottom: 10px; border-bottom: 1px solid #ddd; padding-bottom: 3px;'>" \
+                            f"<b style='color: {role_color};'>{role}:</b><br>{safe_text}</div>"
+            self.flush_messages()
+
+    def flush_messages(self):
+        """Выводит готовые сообщения по порядку: сообщение после еще не отрендеренного ответа ждет его."""
+        if self.pending_messages and self.pending_messages[0].get("stream") and self.stream_start is None:
+            # Потоковый ответ уже заменен окончательным текстом
+            self.pending_messages.popleft()
+        while self.pending_messages and self.pending_messages[0]["html"] is not None:
+            self.chat_display.append(self.pending_messages.popleft()["html"])
 
     def send_message(self):
         text = self.input_field.toPlainText().strip()
@@ -482,20 +566,88 @@ class GLMChatWindow(QWidget):
             thinking=self.cb_thinking.isChecked(),
             temperature=self.temp_slider.value() / 100.0
         )
+        self.worker.partial.connect(self.handle_partial)
         self.worker.finished.connect(self.handle_response)
+        self.worker.cancelled.connect(self.handle_cancelled)
         self.worker.error.connect(self.handle_error)
         self.worker.start()
 
+    def handle_partial(self, text):
+        """Фрагмент ответа: обновление потокового блока не чаще раза в 100 мс."""
+        self.stream_text = text
+        if not self.stream_timer.isActive():
+            self.stream_timer.start()
+
+    def render_stream(self):
+        if not self.stream_text:
+            return
+        if self.stream_start is None:
+            self.flush_messages()
+            if self.pending_messages:
+                return # Сначала должны появиться предыдущие сообщения
+            # Пустой блок в конце документа: дальше он целиком заменяется новым текстом
+            self.chat_display.append("")
+            cursor = self.chat_display.textCursor()
+            cursor.movePosition(QTextCursor.MoveOperation.End)
+            self.stream_start = cursor.position()
+        safe_text = html.escape(self.stream_text).replace('\n', '<br>')
+        self.replace_stream_block(f"<b style='color: #006400;'>GLM-4.5:</b><br>{safe_text}")
+
+    def replace_stream_block(self, msg_html):
+        cursor = QTextCursor(self.chat_display.document())
+        cursor.setPosition(self.stream_start)
+        cursor.movePosition(QTextCursor.MoveOperation.End, QTextCursor.MoveMode.KeepAnchor)
+        cursor.insertHtml(msg_html)
+        self.chat_display.ensureCursorVisible()
+
+    def finish_stream(self, text):
+        """Заменяет потоковый блок окончательным ответом в Markdown (или добавляет ответ, если потока не было)."""
+        self.stream_timer.stop()
+        self.stream_text = ""
+        if self.stream_start is None:
+            self.append_message("GLM-4.5", text)
+            return
+        generation = self.chat_generation
+
+        def on_rendered(html_body, error):
+            if generation != self.chat_generation:
+                return
+            body = html.escape(text).replace('\n', '<br>') if error else html_body
+            self.replace_stream_block(f"<div style='margin-bottom: 12px; border-bottom: 1px dotted #ccc; padding-bottom: 5px;'>"
+                                      f"<b style='color: #006400;'>GLM-4.5:</b><br>{body}</div>")
+            self.stream_start = None
+            self.flush_messages()
+        # Пока финальный HTML рендерится, новые сообщения ждут в очереди за этим ответом
+        self.pending_messages.append({"html": None, "stream": True})
+        md_render.get_service().render(text, on_rendered, CHAT_MARKDOWN_EXTRAS)
+
     def handle_response(self, text):
         self.set_loading(False)
-        self.append_message("GLM-4.5", text)
+        self.finish_stream(text)
+
+    def handle_cancelled(self, text):
+        self.set_loading(False)
+        if text:
+            self.finish_stream(text)
+        else:
+            self.stream_timer.stop()
+            self.stream_text = ""
+        self.append_message("System", "Generation cancelled.")
+
+    def stop_generation(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.cancel()
 
     def handle_error(self, error_msg):
         self.set_loading(False)
+        self.stream_timer.stop()
+        self.stream_text = ""
+        self.stream_start = None
         self.append_message("System Error", f"<i style='color: red;'>{error_msg}</i>")
 
     def set_loading(self, is_loading):
         self.btn_send.setEnabled(not is_loading)
+        self.btn_stop.setVisible(is_loading)
         self.input_field.setEnabled(not is_loading)
         
         # Показываем/скрываем индикатор прогресса
@@ -520,16 +672,27 @@ class GLMChatWindow(QWidget):
         self.progress_bar.setFormat(f"Processing{dots}")
 
     def reset_chat(self):
+        if self.worker is not None and self.worker.isRunning():
+            # Ответ на старый контекст в новый чат не попадает
+            for signal in (self.worker.partial, self.worker.finished, self.worker.cancelled, self.worker.error):
+                signal.disconnect()
+            self.worker.cancel()
+            self.set_loading(False)
+        self.chat_generation += 1
+        self.pending_messages.clear()
+        self.stream_timer.stop()
+        self.stream_text = ""
+        self.stream_start = None
         self.chat_display.clear()
         self.append_message("System", "Chat context cleared.")
-        # Вызов API /reset в фоне
-        try:
-            load_dotenv()
-            hf_token = os.getenv("HF_API_KEY") or os.getenv("HF_TOKEN")
-            client = Client("zai-org/GLM-4.5-Space", token=hf_token)
-            client.predict(api_name="/reset")
-        except:
-            pass
+        # Вызов API /reset в фоне, в той же сессии общего клиента
+        self.run_client_task(lambda client: client.predict(api_name="/reset"))
+
+    def run_client_task(self, func):
+        task = ClientTask(func)
+        task.finished.connect(lambda: self.background_tasks.remove(task))
+        self.background_tasks.append(task)
+        task.start()
 
     def open_notes(self):
         notes = NotesManager(parent=self)
@@ -0,0 +1,109 @@
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class KeyState:
+    """Состояние одного API-ключа: кулдаун, сглаженная задержка и число ошибок подряд."""
+    def __init__(self, key):
+        self.key = key
+        self.cooldown_until = 0.0
+        self.latency = None
+        self.failures = 0
+
+class KeyPool:
+    """
+    Пул ключей одного провайдера. Ключи чередуются по кругу; ключ в кулдауне (после 429 или ошибки)
+    и заметно более медленный, чем лучший, уходят в конец очереди попыток.
+    """
+    COOLDOWN_RATE_LIMIT = 30.0
+    COOLDOWN_AUTH = 300.0
+    COOLDOWN_ERROR = 2.0
+    LATENCY_ALPHA = 0.3   # вес нового замера в EWMA задержки
+    SLOW_FACTOR = 2.0     # во сколько раз медленнее лучшего ключ считается "медленным"
+
+    def __init__(self, keys):
+        self.states = [KeyState(k) for k in keys]
+        self._next = 0
+
+    def sync_keys(self, keys):
+        """Обновляет список ключей после перечитывания .env, сохраняя накопленную статистику."""
+        known = {s.key: s for s in self.states}
+        self.states = [known.get(k) or KeyState(k) for k in keys]
+        self._next %= max(len(self.states), 1)
+
+    def ordered(self):
+        """Ключи в порядке попыток: здоровые по кругу (медленные и сбойные позже), затем остывающие."""
+        if not self.states:
+            return []
+        now = time.monotonic()
+        rotated = self.states[self._next:] + self.states[:self._next]
+        self._next = (self._next + 1) % len(self.states)
+
+        healthy = [s for s in rotated if s.cooldown_until <= now]
+        cooling = sorted((s for s in rotated if s.cooldown_until > now), key=lambda s: s.cooldown_until)
+        latencies = [s.latency for s in healthy if s.latency is not None]
+        best = min(latencies) if latencies else None
+
+        def penalty(state):
+            slow = best is not None and state.latency is not None and state.latency > best * self.SLOW_FACTOR
+            return (state.failures, slow)
+
+        # Сортировка устойчивая: при равном штрафе сохраняется порядок round-robin
+        return [s.key for s in sorted(healthy, key=penalty)] + [s.key for s in cooling]
+
+    def _state(self, key):
+        return next((s for s in self.states if s.key == key), None)
+
+    def report_success(self, key, latency):
+        state = self._state(key)
+        if state is None:
+            return
+        state.failures = 0
+        state.cooldown_until = 0.0
+        state.latency = latency if state.latency is None else \
+            (1 - self.LATENCY_ALPHA) * state.latency + self.LATENCY_ALPHA * latency
+
+    def report_failure(self, key, status_code=None, retry_after=None):
+        """Отправляет ключ в кулдаун: 429 - на Retry-After (или 30 с), 401 - надолго, прочее - с нарастанием."""
+        state = self._state(key)
+        if state is None:
+            return
+        state.failures += 1
+        if status_code == 429:
+            pause = retry_after if retry_after is not None else self.COOLDOWN_RATE_LIMIT
+        elif status_code == 401:
+            pause = self.COOLDOWN_AUTH
+        else:
+            pause = self.COOLDOWN_ERROR * 2 ** min(state.failures - 1, 4)
+        state.cooldown_until = time.monotonic() + pause
+        logger.info(f"Key ...{key[-4:]} cooling down for {pause:.0f}s (status {status_code})")
+
+def resolve_keys(api_key_name):
+    """Список ключей из окружения для имени ключа модели (с учетом запасных ключей провайдера)."""
+    api_keys = []
+    if api_key_name == "OPENROUTER_API_KEY":
+        k1 = os.getenv("OPENROUTER_API_KEY")
+        k2 = os.getenv("OPENROUTER_API_KEY2")
+        if k1: api_keys.append(k1)
+        if k2: api_keys.append(k2)
+    elif api_key_name in ["HF_API_KEY", "HF_TOKEN"]:
+        k = os.getenv("HF_API_KEY") or os.getenv("HF_TOKEN")
+        if k: api_keys.append(k)
+    else:
+        k = os.getenv(api_key_name)
+        if k: api_keys.append(k)
+    return api_keys
+
+_pools = {}
+
+def get_pool(api_key_name):
+    """Пул ключей для имени ключа модели; общий для всех моделей с этим ключом."""
+    keys = resolve_keys(api_key_name)
+    pool = _pools.get(api_key_name)
+    if pool is None:
+        pool = _pools[api_key_name] = KeyPool(keys)
+    elif [s.key for s in pool.states] != keys:
+        pool.sync_keys(keys)
+    return pool
@@ -0,0 +1,79 @@
+import json
+import math
+
+HISTOGRAM_EDGES = (1, 2, 5, 10, 20, 30, 60)
+
+class LatencySketch:
+    """
+    Потоковый скетч квантилей задержки: логарифмические корзины с относительной точностью ~2% (в духе DDSketch).
+    Занимает O(log(max/min)) корзин вне зависимости от числа замеров, хранится как компактный JSON.
+    """
+    RELATIVE_ACCURACY = 0.02
+    MIN_VALUE = 0.001  # 1 мс: все, что меньше, попадает в первую корзину
+
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+
+    def __init__(self, buckets=None):
+        self.buckets = {int(k): int(v) for k, v in (buckets or {}).items()}
+        self.count = sum(self.buckets.values())
+
+    def _index(self, value):
+        return math.ceil(math.log(max(value, self.MIN_VALUE)) / self.LOG_GAMMA)
+
+    def add(self, value):
+        if value is None or value <= 0:
+            return
+        index = self._index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+
+    def remove(self, value):
+        """Убирает ранее добавленный замер (удаление результата); значение попадает в ту же корзину."""
+        if value is None or value <= 0:
+            return
+        index = self._index(value)
+        if self.buckets.get(index, 0) <= 0:
+            return
+        self.buckets[index] -= 1
+        if not self.buckets[index]:
+            del self.buckets[index]
+        self.count -= 1
+
+    def quantile(self, q):
+        """Оценка q-квантиля (0..1) по ближайшему рангу: на малых выборках хвост не теряется; 0.0, если замеров нет."""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(q * self.count - 1e-9))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # Середина корзины (gamma^(i-1), gamma^i] в смысле относительной ошибки
+                return 2 * self.GAMMA ** index / (self.GAMMA + 1)
+        return 2 * self.GAMMA ** max(self.buckets) / (self.GAMMA + 1)
+
+    def percentiles(self):
+        return {"p50": round(self.quantile(0.5), 2), "p90": round(self.quantile(0.9), 2),
+                "p99": round(self.quantile(0.99), 2)}
+
+    def histogram(self, edges=HISTOGRAM_EDGES):
+        """Грубая гистограмма для отображения: число замеров в интервалах между edges (сек)."""
+        counts = [0] * (len(edges) + 1)
+        for index, n in self.buckets.items():
+            value = 2 * self.GAMMA ** index / (self.GAMMA + 1)
+            counts[sum(1 for edge in edges if value > edge)] += n
+        return counts
+
+    @staticmethod
+    def histogram_text(counts, edges=HISTOGRAM_EDGES):
+        """Гистограмма строкой: '≤1s:3 ≤2s:1 >60s:1' (пустые интервалы пропускаются)."""
+        labels = [f"≤{edge}s" for edge in edges] + [f">{edges[-1]}s"]
+        return " ".join(f"{label}:{n}" for label, n in zip(labels, counts) if n)
+
+    def to_json(self):
+        return json.dumps(self.buckets, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(json.loads(data) if data else None)
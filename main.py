@@ -6,14 +6,17 @@ from PyQt6.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QWidget,
                              QTableView, QHeaderView, QAbstractItemView, 
                              QMessageBox, QSplitter, QComboBox, QLineEdit, QFileDialog, 
                              QProgressBar, QTabWidget, QGroupBox, QFormLayout, QDoubleSpinBox, 
-                             QSpinBox, QCheckBox)
-from PyQt6.QtCore import Qt, pyqtSlot, QSortFilterProxyModel
+                             QSpinBox, QCheckBox, QMenu)
+from PyQt6.QtCore import Qt, pyqtSlot, QSortFilterProxyModel, QTimer
 from PyQt6.QtGui import QFont, QColor
 from qasync import QEventLoop, asyncSlot
 import json
+import uuid
 
 from notes_manager import NotesManager
 import db
+import db_writer
+import conversation
 import models_logic
 import network
 from hf_space_chat import GLMChatWindow
@@ -45,6 +48,7 @@ class MainWindow(QMainWindow):
         models_logic.setup_default_models()
         
         self.special_chat_window = None
+        self.current_run = None # Текущая рассылка (network.FanoutRun), пока она идет
         self.models_manager_window = None
         self.results_journal_window = None
         self.notes_manager_window = None
@@ -57,6 +61,8 @@ class MainWindow(QMainWindow):
         self.proxy_model.setFilterCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
         
         self.init_ui()
+        # Держим виджеты настроек в синхроне с хранилищем настроек
+        db.subscribe_settings(self.on_setting_changed)
         # Слушаем переключение вкладок для обновления истории
         self.prompt_tabs.currentChanged.connect(self.load_history)
         self.center()
@@ -132,7 +138,18 @@ class MainWindow(QMainWindow):
         btn_delete_prompt.setStyleSheet("background-color: #450a0a; color: #ef4444; border: 1px solid #7f1d1d; padding: 4px 8px;")
         btn_delete_prompt.clicked.connect(self.on_delete_prompt_clicked)
         
+        # Поиск по истории слота (полнотекстовый индекс), найденные промпты - по релевантности
+        self.history_search = QLineEdit()
+        self.history_search.setPlaceholderText("🔍 Search history...")
+        self.history_search.setMaximumWidth(200)
+        self.history_search_timer = QTimer(self)
+        self.history_search_timer.setSingleShot(True)
+        self.history_search_timer.setInterval(250)
+        self.history_search_timer.timeout.connect(self.load_history)
+        self.history_search.textChanged.connect(self.history_search_timer.start)
+
         history_layout.addWidget(history_label)
+        history_layout.addWidget(self.history_search)
         history_layout.addWidget(self.prompt_history)
         history_layout.addWidget(btn_save_prompt)
         history_layout.addWidget(btn_delete_prompt)
@@ -191,10 +208,65 @@ class MainWindow(QMainWindow):
         self.cb_thinking.setChecked(db.get_setting("global_thinking", "0") == "1")
         self.cb_thinking.toggled.connect(lambda v: db.set_setting("global_thinking", "1" if v else "0"))
         
+        self.cb_stream = QCheckBox("Streaming (SSE)")
+        self.cb_stream.setToolTip("Show partial answers as tokens arrive (stream: true).")
+        self.cb_stream.setChecked(db.get_setting("global_stream", "0") == "1")
+        self.cb_stream.toggled.connect(lambda v: db.set_setting("global_stream", "1" if v else "0"))
+        
         settings_form.addRow("Temperature:", self.spin_temp)
         settings_form.addRow("Max Tokens:", self.spin_tokens)
         settings_form.addRow("Top P:", self.spin_top_p)
         settings_form.addRow(self.cb_thinking)
+        settings_form.addRow(self.cb_stream)
+        
+        self.cb_use_cache = QCheckBox("Use cache")
+        self.cb_use_cache.setToolTip("Reuse saved answers for the same model, prompt and sampling params\n"
+                                     "instead of sending (and paying for) the request again.")
+        self.cb_use_cache.setChecked(db.get_setting("global_use_cache", "0") == "1")
+        self.cb_use_cache.toggled.connect(lambda v: db.set_setting("global_use_cache", "1" if v else "0"))
+        settings_form.addRow(self.cb_use_cache)
+        
+        self.cb_prefix_cache = QCheckBox("Prefix caching")
+        self.cb_prefix_cache.setToolTip("For providers with prompt prefix caching (OpenAI, DeepSeek, Claude/Gemini via OpenRouter):\n"
+                                        "send stable P2/P3 first and the changing P1 task last, and mark the stable part\n"
+                                        "with cache hints. Other providers get P1, P2, P3 as usual.")
+        self.cb_prefix_cache.setChecked(db.get_setting("prefix_cache", "1") == "1")
+        self.cb_prefix_cache.toggled.connect(lambda v: db.set_setting("prefix_cache", "1" if v else "0"))
+        settings_form.addRow(self.cb_prefix_cache)
+        
+        self.spin_deadline = QSpinBox()
+        self.spin_deadline.setRange(0, 600)
+        self.spin_deadline.setSuffix(" s")
+        self.spin_deadline.setSpecialValueText("Off")
+        self.spin_deadline.setToolTip("Return whatever arrived within this time and cancel the rest.")
+        self.spin_deadline.setValue(int(float(db.get_setting("run_deadline", 0))))
+        self.spin_deadline.valueChanged.connect(lambda v: db.set_setting("run_deadline", v))
+        
+        self.spin_stop_after = QSpinBox()
+        self.spin_stop_after.setRange(0, 100)
+        self.spin_stop_after.setSpecialValueText("All")
+        self.spin_stop_after.setToolTip("Stop the run after this many successful answers.")
+        self.spin_stop_after.setValue(int(float(db.get_setting("run_stop_after", 0))))
+        self.spin_stop_after.valueChanged.connect(lambda v: db.set_setting("run_stop_after", v))
+        
+        self.cb_session = QCheckBox("Session mode")
+        self.cb_session.setToolTip("Keep a per-model conversation: P1 is sent as the system message,\n"
+                                   "P2+P3 as the next user turn, and older turns are trimmed to the token budget.")
+        self.cb_session.setChecked(db.get_setting("global_session_mode", "0") == "1")
+        self.cb_session.toggled.connect(lambda v: db.set_setting("global_session_mode", "1" if v else "0"))
+        settings_form.addRow(self.cb_session)
+        
+        self.spin_context_budget = QSpinBox()
+        self.spin_context_budget.setRange(500, 1000000)
+        self.spin_context_budget.setSingleStep(1000)
+        self.spin_context_budget.setSuffix(" tok")
+        self.spin_context_budget.setToolTip("Session history budget per request (per-model override: setting context_budget:<model>).")
+        self.spin_context_budget.setValue(int(float(db.get_setting("context_budget_tokens", conversation.DEFAULT_BUDGET_TOKENS))))
+        self.spin_context_budget.valueChanged.connect(lambda v: db.set_setting("context_budget_tokens", v))
+        settings_form.addRow("Context:", self.spin_context_budget)
+        
+        settings_form.addRow("Deadline:", self.spin_deadline)
+        settings_form.addRow("Stop after OK:", self.spin_stop_after)
         
         prompts_settings_layout.addWidget(self.prompt_tabs, 3)
         prompts_settings_layout.addWidget(settings_group, 1)
@@ -207,8 +279,20 @@ class MainWindow(QMainWindow):
         btn_preview = QPushButton("🔍 Предпросмотр")
         btn_preview.clicked.connect(self.on_preview_prompt_clicked)
         
+        self.btn_stop = QPushButton("⛔ Стоп")
+        self.btn_stop.setToolTip("Cancel all running requests and keep the answers that already arrived.")
+        self.btn_stop.setStyleSheet("background-color: #450a0a; color: #ef4444; border: 1px solid #7f1d1d;")
+        self.btn_stop.setEnabled(False)
+        self.btn_stop.clicked.connect(self.on_stop_clicked)
+        
+        btn_new_session = QPushButton("🆕 New Session")
+        btn_new_session.setToolTip("Forget the conversation history of all models (session mode).")
+        btn_new_session.clicked.connect(self.on_new_session_clicked)
+        
         btn_row_layout = QHBoxLayout()
         btn_row_layout.addWidget(btn_send, 4)
+        btn_row_layout.addWidget(self.btn_stop, 1)
+        btn_row_layout.addWidget(btn_new_session, 1)
         btn_row_layout.addWidget(btn_preview, 1)
 
         input_layout.addWidget(prompt_label)
@@ -254,10 +338,32 @@ class MainWindow(QMainWindow):
         self.results_table.setColumnWidth(4, 70)  # Symbols
         self.results_table.setColumnWidth(5, 80)  # Status
         self.results_table.setColumnWidth(6, 80)  # Preview
-        self.results_table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        # Высота строк считается только для изменившихся строк (см. refresh_rows), а не для всей таблицы на каждое изменение
+        self.results_table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Interactive)
         self.results_table.setWordWrap(True)
         self.results_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
         self.results_table.doubleClicked.connect(self.on_table_double_clicked)
+        self.row_heights = {} # Кеш высот по строкам исходной модели
+        self.results_model.dataChanged.connect(self.on_results_data_changed)
+        self.results_model.rowsInserted.connect(lambda parent, first, last: self.refresh_rows(first, last))
+        self.results_model.modelReset.connect(self.row_heights.clear)
+        self.proxy_model.layoutChanged.connect(self.apply_row_heights)
+        self.proxy_model.rowsInserted.connect(self.apply_row_heights)
+        # Ширина колонок меняется сериями событий (растягивание окна): пересчет всех высот - один раз после паузы
+        self.row_resize_timer = QTimer(self)
+        self.row_resize_timer.setSingleShot(True)
+        self.row_resize_timer.setInterval(150)
+        self.row_resize_timer.timeout.connect(self.refresh_all_rows)
+        self.results_table.horizontalHeader().sectionResized.connect(lambda *args: self.row_resize_timer.start())
+        # Фрагменты потока копятся и показываются раз в 100 мс; высота строки, пока идет поток, не пересчитывается
+        self.streaming_rows = set()
+        self.dirty_stream_rows = set()
+        self.stream_update_timer = QTimer(self)
+        self.stream_update_timer.setSingleShot(True)
+        self.stream_update_timer.setInterval(100)
+        self.stream_update_timer.timeout.connect(self.flush_stream_rows)
+        self.results_table.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.results_table.customContextMenuRequested.connect(self.on_table_context_menu)
         
         # Action Buttons for Results
         actions_layout = QHBoxLayout()
@@ -345,6 +451,8 @@ class MainWindow(QMainWindow):
         self.btn_send.setText("Подключение к моделям...")
         
         self.results_model.update_data([])
+        self.streaming_rows.clear()
+        self.dirty_stream_rows.clear()
         # Подсвечиваем активные модели в таблице
         self.results_model.set_active_models([m[0] for m in active_models])
         
@@ -354,8 +462,6 @@ class MainWindow(QMainWindow):
         
         try:
             completed = 0
-            all_results = []
-            delay_step = float(db.get_setting("request_delay", 0.0))
             timeout = float(db.get_setting("request_timeout", 60.0))
             
             # Предварительно загружаем метрики всех моделей для отображения в результатах
@@ -366,9 +472,22 @@ class MainWindow(QMainWindow):
             max_tokens = self.spin_tokens.value()
             top_p = self.spin_top_p.value()
             thinking = self.cb_thinking.isChecked()
-
-            async def wrap_task(task, model_info):
-                res = await task
+            stream = self.cb_stream.isChecked()
+            use_cache = self.cb_use_cache.isChecked()
+            # Общий ID рассылки: по нему журнал считает расход токенов и стоимость запуска
+            run_id = uuid.uuid4().hex[:12]
+
+            # Режим сессии: P1 - system, P2+P3 - очередной ход пользователя поверх истории каждой модели
+            session_input = None
+            session_messages = {}
+            if self.cb_session.isChecked():
+                session_input = "\n\n".join([p for p in [p2, p3] if p])
+                system_prompt = p1 if session_input else ""
+                session_input = session_input or p1
+                session_messages = {m[0]: conversation.build_messages(m[0], system_prompt, session_input)
+                                    for m in active_models}
+
+            def fill_meta(res, model_info):
                 res['api_url'] = model_info[1]
                 res['api_key_name'] = model_info[2]
                 res['slot'] = "P1+P2+P3" 
@@ -379,71 +498,154 @@ class MainWindow(QMainWindow):
                 res['max_tokens'] = max_tokens
                 res['top_p'] = top_p
                 res['thinking'] = thinking
+                res['session_input'] = session_input
+                res['run_id'] = run_id
+                res['messages'] = session_messages.get(res['model'])
                 # Подтягиваем исторические метрики
                 res['metrics'] = all_metrics.get(res['model'], {"avg_time": 0, "errors": 0})
                 return res
 
-            wrapped_tasks = [wrap_task(network.delayed_fetch(
-                                 i * delay_step, m[0], m[1], m[2], combined_prompt, timeout,
-                                 temperature=temperature, max_tokens=max_tokens, top_p=top_p, thinking=thinking
-                              ), m) for i, m in enumerate(active_models)]
+            def make_chunk_handler(row):
+                def on_chunk(text):
+                    all_results[row]['response'] = text
+                    self.streaming_rows.add(row)
+                    self.dirty_stream_rows.add(row)
+                    if not self.stream_update_timer.isActive():
+                        self.stream_update_timer.start()
+                return on_chunk
+
+            # Строки создаются заранее: каждый ответ (или фрагмент потока) обновляет только свою строку,
+            # а еще не ответившую модель можно отменить из контекстного меню
+            waiting = "Streaming..." if stream else "Waiting..."
+            all_results = [fill_meta({"model": m[0], "response": "", "status": waiting, "resp_time": 0.0}, m)
+                           for m in active_models]
+            self.results_model.append_rows(all_results)
+
+            # Темп и параллелизм по каждому провайдеру регулирует scheduler, модели разных провайдеров не ждут друг друга
+            run = network.FanoutRun(deadline=self.spin_deadline.value(), stop_after=self.spin_stop_after.value())
+            for i, m in enumerate(active_models):
+                run.add(i, m[0], network.fetch_model_response(
+                    m[0], m[1], m[2], combined_prompt, timeout,
+                    temperature=temperature, max_tokens=max_tokens, top_p=top_p, thinking=thinking,
+                    stream=stream, on_chunk=make_chunk_handler(i) if stream else None, use_cache=use_cache,
+                    messages=session_messages.get(m[0]), parts=(p1, p2, p3)))
+            self.current_run = run
+            self.btn_stop.setEnabled(True)
             
-            for future in asyncio.as_completed(wrapped_tasks):
-                res = await future
-                all_results.append(res)
+            async for row, res in run.results():
                 completed += 1
                 self.progress_bar.setValue(completed)
                 self.btn_send.setText(f"Выполнено: {completed}/{len(active_models)}")
                 self.table_info_label.setText(f"Сравнение ответов (Завершено: {completed}/{len(active_models)})")
-                self.results_model.update_data(all_results.copy())
-                self.results_table.resizeRowsToContents()
+                # У отмененного потока остается уже полученный текст
+                res['response'] = res['response'] or all_results[row]['response']
+                res['cost'] = self.result_cost(res)
+                all_results[row].update(fill_meta(res, active_models[row]))
+                # Окончательный ответ: строка больше не в потоке, ее высота пересчитывается
+                self.streaming_rows.discard(row)
+                self.dirty_stream_rows.discard(row)
+                self.results_model.update_row(row)
+                if session_input is not None and res['status'].startswith("Success"):
+                    conversation.record_reply(res['model'], session_input, res['response'])
                 
         except Exception as e:
             logger.error(f"Error during triple send: {e}")
             QMessageBox.critical(self, "Error", str(e))
         finally:
+            self.current_run = None
+            self.streaming_rows.clear()
+            self.btn_stop.setEnabled(False)
             self.btn_send.setEnabled(True)
             self.btn_send.setText("Отправить тройной промпт")
             self.progress_bar.setVisible(False)
 
-    def save_selected(self):
+    def flush_stream_rows(self):
+        """Показывает накопленный текст потоковых ответов (не чаще раза в 100 мс)."""
+        rows, self.dirty_stream_rows = self.dirty_stream_rows, set()
+        for row in sorted(rows):
+            self.results_model.update_row(row)
+
+    def on_results_data_changed(self, top_left, bottom_right, roles=()):
+        # Фон и галочка выбора на высоту строки не влияют
+        if not roles or Qt.ItemDataRole.DisplayRole in roles:
+            for row in range(top_left.row(), bottom_right.row() + 1):
+                # Пока ответ приходит потоком, высота строки не пересчитывается на каждый фрагмент
+                if row not in self.streaming_rows:
+                    self.refresh_rows(row, row)
+
+    def refresh_rows(self, first, last):
+        """Пересчитывает высоту строк first..last исходной модели и запоминает ее в кеше."""
+        for source_row in range(first, last + 1):
+            view_row = self.proxy_model.mapFromSource(self.results_model.index(source_row, 0)).row()
+            if view_row < 0:
+                continue # Строка скрыта фильтром
+            self.results_table.resizeRowToContents(view_row)
+            self.row_heights[source_row] = self.results_table.rowHeight(view_row)
+
+    def apply_row_heights(self, *args):
+        """После сортировки или фильтрации возвращает строкам их высоты из кеша, не измеряя текст заново."""
+        for source_row, height in self.row_heights.items():
+            view_index = self.proxy_model.mapFromSource(self.results_model.index(source_row, 0))
+            if view_index.isValid():
+                self.results_table.setRowHeight(view_index.row(), height)
+
+    def refresh_all_rows(self):
+        # Перенос текста зависит от ширины колонок: кеш высот устаревает целиком
+        self.row_heights.clear()
+        if self.results_model.rowCount():
+            self.refresh_rows(0, self.results_model.rowCount() - 1)
+
+    def result_cost(self, res):
+        """Стоимость ответа: сообщенная провайдером, иначе по таблице цен модели (None, если цены нет)."""
+        if res.get('provider_cost') is not None:
+            return res['provider_cost']
+        return db.estimate_cost(res['model'], res)
+
+    def on_new_session_clicked(self):
+        conversation.reset()
+        self.table_info_label.setText("Model Responses Comparison: new session started")
+
+    def on_stop_clicked(self):
+        """Отменяет все еще идущие запросы текущей рассылки."""
+        if self.current_run is not None:
+            self.current_run.cancel_all()
+
+    def on_table_context_menu(self, pos):
+        """Контекстное меню строки результатов: отмена запроса, который еще выполняется."""
+        index = self.results_table.indexAt(pos)
+        if not index.isValid():
+            return
+        row = self.proxy_model.mapToSource(index).row()
+        # Рассылка продолжается, пока меню открыто: запоминаем ее до exec(), к закрытию меню
+        # current_run может уже обнулиться или смениться следующей рассылкой
+        run = self.current_run
+        menu = QMenu(self)
+        action_cancel = menu.addAction("⛔ Cancel request")
+        action_cancel.setEnabled(run is not None and run.is_running(row))
+        if menu.exec(self.results_table.viewport().mapToGlobal(pos)) == action_cancel and run is not None:
+            run.cancel(row)
+
+    @asyncSlot()
+    async def save_selected(self):
         selected_data = [row for row in self.results_model._data if row.get('selected')]
         
         if not selected_data:
             QMessageBox.information(self, "Save", "Please select responses to save.")
             return
 
-        saved_count = 0
-        for item in selected_data:
-            # Распределяем части по своим таблицам истории
-            parts = {
-                "prompts": item.get('p1', ""),
-                "prompts2": item.get('p2', ""),
-                "prompts3": item.get('p3', "")
-            }
-            
-            p1_id = None
-            for table_name, text in parts.items():
-                if text:
-                    pid = db.get_prompt_id(text, table=table_name)
-                    if pid is None:
-                        pid = db.add_prompt(text, table=table_name)
-                    if table_name == "prompts":
-                        p1_id = pid
-            
-            # Собираем полный промпт для сохранения в результат
-            full_prompt_text = "\n\n".join([p for p in [parts["prompts"], parts["prompts2"], parts["prompts3"]] if p])
-            
-            # Результат привязываем к P1 (если он есть) или к 0, передаем полный текст и метрики
-            db.save_result(p1_id or 0, item['model'], item['response'], table="results", 
-                           full_prompt=full_prompt_text, resp_time=item.get('resp_time', 0.0), 
-                           status=item.get('status', 'Success'))
-            saved_count += 1
-            
+        # Все строки, промпты по слотам и результаты - одной транзакцией в потоке записи
+        try:
+            saved_ids = await db_writer.run(db.save_results_batch, selected_data)
+        except Exception as e:
+            logger.error(f"Save error: {e}")
+            QMessageBox.critical(self, "Error", f"Could not save results: {e}")
+            return
+        saved_count = len(saved_ids)
         QMessageBox.information(self, "Success", f"Saved {saved_count} items. Prompts sorted to slots.")
         self.load_history()
 
-    def on_save_prompt_clicked(self):
+    @asyncSlot()
+    async def on_save_prompt_clicked(self):
         """Сохранение текущего активного промпта в его таблицу."""
         cur_idx = self.prompt_tabs.currentIndex()
         text = [self.p1_input, self.p2_input, self.p3_input][cur_idx].toPlainText().strip()
@@ -452,12 +654,12 @@ class MainWindow(QMainWindow):
         p_table = "prompts" if cur_idx == 0 else f"prompts{cur_idx+1}"
         
         existing_id = db.get_prompt_id(text, table=p_table)
+        await db_writer.run(db.add_prompt, text, table=p_table)
         if existing_id:
-            QMessageBox.information(self, "Status", f"Prompt already exists in history {cur_idx+1}.")
+            QMessageBox.information(self, "Status", f"Prompt already exists in history {cur_idx+1}: moved to the top.")
         else:
-            db.add_prompt(text, table=p_table)
             QMessageBox.information(self, "Success", f"Prompt saved to history {cur_idx+1}.")
-            self.load_history()
+        self.load_history()
 
     def on_history_selected(self, index):
         """Вставка текста из истории в текущую активную вкладку."""
@@ -469,7 +671,8 @@ class MainWindow(QMainWindow):
                 inputs[cur_tab].setPlainText(full_text)
                 logger.info("Prompt loaded from history to current tab.")
 
-    def on_delete_prompt_clicked(self):
+    @asyncSlot()
+    async def on_delete_prompt_clicked(self):
         """Удаление промпта из таблицы текущей активной вкладки."""
         index = self.prompt_history.currentIndex()
         if index <= 0: return
@@ -481,7 +684,7 @@ class MainWindow(QMainWindow):
         confirm = QMessageBox.question(self, "Delete", f"Are you sure you want to delete this prompt from history {cur_tab+1}?", 
                                      QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
         if confirm == QMessageBox.StandardButton.Yes:
-            db.delete_prompt(prompt_id, table=p_table)
+            await db_writer.run(db.delete_prompt, prompt_id, table=p_table)
             self.load_history()
 
     def on_preview_prompt_clicked(self):
@@ -495,14 +698,21 @@ class MainWindow(QMainWindow):
             QMessageBox.information(self, "Preview", "Prompt is empty.")
             return
             
-        viewer = MarkdownViewer("Prompt Preview", f"```text\n{combined}\n```", self)
+        preview = f"```text\n{combined}\n```"
+        reordered = [m[0] for m in models_logic.get_active_models_with_keys()
+                     if network.reorders_prompt(m[0], m[1], p1, p2, p3)]
+        if reordered:
+            # Этим моделям ради кеша префикса промпт уходит в другом порядке
+            sent = "\n\n".join([p for p in [p2, p3, p1] if p])
+            preview += f"\n\n**Prefix caching order (P2, P3, P1)** for: {', '.join(reordered)}\n\n```text\n{sent}\n```"
+        viewer = MarkdownViewer("Prompt Preview", preview, self)
         viewer.exec()
 
     @asyncSlot()
     async def on_retry_errors_clicked(self):
-        """Повторный запрос для тех моделей, которые вернули ошибку."""
+        """Повторный запрос для тех моделей, которые вернули ошибку или были отменены."""
         data = self.results_model._data
-        failed_indices = [i for i, item in enumerate(data) if item.get('status', '').startswith("Error")]
+        failed_indices = [i for i, item in enumerate(data) if item.get('status', '').startswith(("Error", "Cancelled"))]
         
         if not failed_indices:
             QMessageBox.information(self, "Retry", "No errors found to retry.")
@@ -521,7 +731,6 @@ class MainWindow(QMainWindow):
         self.btn_retry.setText("Retrying...")
         
         try:
-            delay_step = float(db.get_setting("request_delay", 0.0))
             timeout = float(db.get_setting("request_timeout", 60.0))
             
             # Считываем текущие настройки из интерфейса
@@ -530,7 +739,7 @@ class MainWindow(QMainWindow):
             top_p = self.spin_top_p.value()
             thinking = self.cb_thinking.isChecked()
 
-            async def run_retry(idx, delay):
+            async def run_retry(idx):
                 item = data[idx]
                 model_name = item['model']
                 api_url = item.get('api_url')
@@ -546,14 +755,24 @@ class MainWindow(QMainWindow):
                             break
                     if not found:
                         item['status'] = "Error: Model info missing"
+                        self.results_model.update_row(idx)
                         return
 
-                res = await network.delayed_fetch(
-                    delay, model_name, api_url, api_key_name, combined_prompt, timeout,
-                    temperature=temperature, max_tokens=max_tokens, top_p=top_p, thinking=thinking
+                # Строка из режима сессии повторяется с теми же сообщениями, что и исходный запрос
+                res = await network.fetch_model_response(
+                    model_name, api_url, api_key_name, combined_prompt, timeout,
+                    temperature=temperature, max_tokens=max_tokens, top_p=top_p, thinking=thinking,
+                    messages=item.get('messages'), parts=(p1, p2, p3)
                 )
+                if item.get('session_input') is not None and res['status'].startswith("Success"):
+                    conversation.record_reply(model_name, item['session_input'], res['response'])
                 item['response'] = res['response']
                 item['status'] = res['status']
+                # Время, токены и стоимость - от нового ответа
+                for key in ('resp_time', 'ttft', 'tokens_per_sec', 'prompt_tokens', 'completion_tokens',
+                            'reasoning_tokens', 'cached_tokens', 'provider_cost', 'full_prompt'):
+                    item[key] = res.get(key)
+                item['cost'] = self.result_cost(res)
                 item['api_url'] = api_url 
                 item['api_key_name'] = api_key_name
                 # Обновляем сохраненные настройки в элементе
@@ -561,14 +780,12 @@ class MainWindow(QMainWindow):
                 item['max_tokens'] = max_tokens
                 item['top_p'] = top_p
                 item['thinking'] = thinking
+                # Перерисовывается только эта строка
+                self.results_model.update_row(idx)
 
-            tasks = [run_retry(idx, i * delay_step) for i, idx in enumerate(failed_indices)]
+            tasks = [run_retry(idx) for idx in failed_indices]
             await asyncio.gather(*tasks)
 
-            # Обновляем таблицу атомарно
-            self.results_model.beginResetModel()
-            self.results_model.endResetModel()
-            self.results_table.resizeRowsToContents()
             QMessageBox.information(self, "Retry", f"Retry completed for {len(failed_indices)} items.")
             
         except Exception as e:
@@ -578,6 +795,28 @@ class MainWindow(QMainWindow):
             self.btn_retry.setEnabled(True)
             self.btn_retry.setText("🔄 Retry Errors")
 
+    def on_setting_changed(self, key, value):
+        """Обновляет виджет глобальных настроек, если значение изменилось не через него."""
+        spins = {"global_temp": (self.spin_temp, float),
+                 "global_max_tokens": (self.spin_tokens, lambda v: int(float(v))),
+                 "global_top_p": (self.spin_top_p, float),
+                 "run_deadline": (self.spin_deadline, lambda v: int(float(v))),
+                 "run_stop_after": (self.spin_stop_after, lambda v: int(float(v))),
+                 "context_budget_tokens": (self.spin_context_budget, lambda v: int(float(v)))}
+        checks = {"global_thinking": self.cb_thinking, "global_stream": self.cb_stream,
+                  "global_use_cache": self.cb_use_cache, "global_session_mode": self.cb_session,
+                  "prefix_cache": self.cb_prefix_cache}
+        if key in spins:
+            spin, cast = spins[key]
+            if spin.value() != cast(value):
+                spin.blockSignals(True)
+                spin.setValue(cast(value))
+                spin.blockSignals(False)
+        elif key in checks and checks[key].isChecked() != (value == "1"):
+            checks[key].blockSignals(True)
+            checks[key].setChecked(value == "1")
+            checks[key].blockSignals(False)
+
     def update_tab_indicators(self):
         """Меняет цвет текста вкладок на салатовый, если в них есть текст."""
         inputs = [self.p1_input, self.p2_input, self.p3_input]
@@ -593,14 +832,23 @@ class MainWindow(QMainWindow):
             cur_tab = self.prompt_tabs.currentIndex()
             p_table = "prompts" if cur_tab == 0 else f"prompts{cur_tab+1}"
             
-            prompts = db.get_prompts(table=p_table)
+            query = self.history_search.text().strip()
+            if query:
+                # (id, date, prompt, фрагмент с подсветкой совпадений)
+                prompts = db.search_prompts(query, table=p_table)
+            else:
+                prompts = [(p[0], p[1], p[2], p[2]) for p in db.get_prompts(table=p_table)]
             self.prompt_history.blockSignals(True)
             self.prompt_history.clear()
-            self.prompt_history.addItem(f"-- History for Slot {cur_tab+1} --")
-            for p in prompts:
-                short_text = (p[2][:50] + '...') if len(p[2]) > 50 else p[2]
-                self.prompt_history.addItem(f"{p[1][:10]} | {short_text}", p[2])
-                self.prompt_history.setItemData(self.prompt_history.count()-1, p[0], Qt.ItemDataRole.UserRole + 1)
+            if query:
+                self.prompt_history.addItem(f"-- Found in Slot {cur_tab+1}: {len(prompts)} --")
+            else:
+                self.prompt_history.addItem(f"-- History for Slot {cur_tab+1} --")
+            for prompt_id, date, text, snippet in prompts:
+                snippet = " ".join(snippet.split())
+                short_text = (snippet[:50] + '...') if not query and len(snippet) > 50 else snippet
+                self.prompt_history.addItem(f"{date[:10]} | {short_text}", text)
+                self.prompt_history.setItemData(self.prompt_history.count()-1, prompt_id, Qt.ItemDataRole.UserRole + 1)
             self.prompt_history.blockSignals(False)
         except Exception as e:
             logger.error(f"Error loading history for {p_table}: {e}")
@@ -653,6 +901,9 @@ class MainWindow(QMainWindow):
             # Экспортируем полное объединение
             prompt = "\n\n".join([i.toPlainText().strip() for i in inputs if i.toPlainText().strip()])
             md_content = f"# ChatList Export (Triple Combined)\n\n**Full Prompt:**\n{prompt}\n\n"
+            reordered = [row['model'] for row in data if row.get('full_prompt') and row['full_prompt'] != prompt]
+            if reordered:
+                md_content += f"**Sent as P2, P3, P1 (prefix caching):** {', '.join(reordered)}\n\n"
             md_content += "| Model | Response | Symbols | Status |\n"
             md_content += "|-------|----------|---------|--------|\n"
             
@@ -710,6 +961,11 @@ def main():
     
     with loop:
         loop.run_forever()
+        # Корректно закрываем общие HTTP-клиенты до закрытия цикла
+        loop.run_until_complete(network.close_clients())
+    # Дописываем очередь фоновой записи (сохранения, настройки) до закрытия соединений
+    db_writer.shutdown()
+    db.close_connections()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,109 @@
+import hashlib
+import logging
+import queue
+import threading
+from collections import OrderedDict
+import markdown2
+from PyQt6.QtCore import QObject, pyqtSignal
+
+logger = logging.getLogger(__name__)
+
+MARKDOWN_EXTRAS = ("fenced-code-blocks", "tables", "break-on-newline")
+
+class MarkdownRenderService(QObject):
+    """
+    Рендер Markdown -> HTML в фоновом потоке. Готовый HTML запоминается по хешу содержимого (LRU по объему),
+    поэтому повторное открытие того же ответа не рендерит его заново. Результат приходит в GUI-поток через сигнал.
+    """
+    rendered = pyqtSignal(int, str, str)  # номер запроса, html, текст ошибки
+
+    CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+    def __init__(self):
+        super().__init__()
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._cache_lock = threading.Lock()
+        self._callbacks = {}
+        self._next_ticket = 0
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, name="md-render", daemon=True)
+        self._thread.start()
+        self.rendered.connect(self._deliver)
+
+    @staticmethod
+    def _key(text, extras):
+        raw = "\x00".join(extras) + "\x00" + text
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _cached(self, key):
+        with self._cache_lock:
+            html = self._cache.get(key)
+            if html is not None:
+                self._cache.move_to_end(key)
+            return html
+
+    def _remember(self, key, html):
+        with self._cache_lock:
+            if key in self._cache:
+                return
+            self._cache[key] = html
+            self._cache_bytes += len(html)
+            while self._cache_bytes > self.CACHE_MAX_BYTES and len(self._cache) > 1:
+                _, old = self._cache.popitem(last=False)
+                self._cache_bytes -= len(old)
+
+    def render(self, text, callback, extras=MARKDOWN_EXTRAS):
+        """
+        Запрашивает HTML для text; callback(html, error) вызывается в GUI-потоке
+        (сразу, если результат уже в кеше). Возвращает номер запроса для cancel().
+        """
+        extras = tuple(extras)
+        key = self._key(text, extras)
+        self._next_ticket += 1
+        ticket = self._next_ticket
+        html = self._cached(key)
+        if html is not None:
+            callback(html, "")
+            return ticket
+        self._callbacks[ticket] = callback
+        self._jobs.put((ticket, key, text, extras))
+        return ticket
+
+    def cancel(self, ticket):
+        """Результат запроса больше не нужен (окно закрыто): callback не будет вызван."""
+        self._callbacks.pop(ticket, None)
+
+    def _worker(self):
+        while True:
+            ticket, key, text, extras = self._jobs.get()
+            # Одинаковый текст мог быть запрошен несколько раз подряд: второй раз берем из кеша
+            html = self._cached(key)
+            error = ""
+            if html is None:
+                try:
+                    html = markdown2.markdown(text, extras=list(extras))
+                    self._remember(key, html)
+                except Exception as e:
+                    logger.error(f"Markdown render failed: {e}")
+                    html, error = "", str(e)
+            self.rendered.emit(ticket, html, error)
+
+    def _deliver(self, ticket, html, error):
+        callback = self._callbacks.pop(ticket, None)
+        if callback is None:
+            return
+        try:
+            callback(html, error)
+        except RuntimeError:
+            # Виджет получателя уже удален Qt
+            pass
+
+_service = None
+
+def get_service():
+    """Общий сервис рендера (создается при первом обращении, после QApplication)."""
+    global _service
+    if _service is None:
+        _service = MarkdownRenderService()
+    return _service
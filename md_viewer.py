@@ -1,6 +1,17 @@
 from PyQt6.QtWidgets import QDialog, QVBoxLayout, QTextEdit, QPushButton
 from PyQt6.QtCore import Qt
-import markdown2
+import md_render
+
+# Базовые стили CSS для отрендеренного Markdown
+STYLE = """
+    body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; line-height: 1.6; color: #333; }
+    code { background-color: #f4f4f4; padding: 2px 4px; border-radius: 4px; font-family: Consolas, monospace; }
+    pre { background-color: #f4f4f4; padding: 10px; border-radius: 5px; border: 1px solid #ddd; }
+    table { border-collapse: collapse; width: 100%; margin-bottom: 1em; }
+    th, td { border: 1px solid #ddd; padding: 8px; text-align: left; }
+    th { background-color: #f2f2f2; }
+    blockquote { border-left: 5px solid #ccc; margin: 1.5em 10px; padding: 0.5em 10px; color: #666; font-style: italic; }
+"""
 
 class MarkdownViewer(QDialog):
     def __init__(self, model_name, content, parent=None):
@@ -15,33 +26,12 @@ class MarkdownViewer(QDialog):
         self.viewer.setReadOnly(True)
         self.viewer.setStyleSheet("background-color: #ffffff; color: #000000; padding: 10px;")
         
-        # Конвертация Markdown в HTML
-        try:
-            # Используем экстра-фичи для лучшего рендеринга таблиц и списков
-            html_content = markdown2.markdown(content, extras=["fenced-code-blocks", "tables", "break-on-newline"])
-            
-            # Добавляем базовые стили CSS для красоты
-            styled_html = f"""
-            <html>
-            <head>
-            <style>
-                body {{ font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; line-height: 1.6; color: #333; }}
-                code {{ background-color: #f4f4f4; padding: 2px 4px; border-radius: 4px; font-family: Consolas, monospace; }}
-                pre {{ background-color: #f4f4f4; padding: 10px; border-radius: 5px; border: 1px solid #ddd; }}
-                table {{ border-collapse: collapse; width: 100%; margin-bottom: 1em; }}
-                th, td {{ border: 1px solid #ddd; padding: 8px; text-align: left; }}
-                th {{ background-color: #f2f2f2; }}
-                blockquote {{ border-left: 5px solid #ccc; margin: 1.5em 10px; padding: 0.5em 10px; color: #666; font-style: italic; }}
-            </style>
-            </head>
-            <body>
-                {html_content}
-            </body>
-            </html>
-            """
-            self.viewer.setHtml(styled_html)
-        except Exception as e:
-            self.viewer.setPlainText(f"Error rendering Markdown: {e}\n\nOriginal text:\n{content}")
+        # Рендер идет в фоновом потоке: большой ответ не подвешивает окно, пока пользователь видит заглушку
+        self.content = content or ""
+        self.viewer.setPlainText("Rendering...")
+        service = md_render.get_service()
+        ticket = service.render(self.content, self.on_rendered)
+        self.destroyed.connect(lambda: service.cancel(ticket))
             
         layout.addWidget(self.viewer)
         
@@ -49,3 +39,9 @@ class MarkdownViewer(QDialog):
         btn_close.clicked.connect(self.close)
         btn_close.setStyleSheet("background-color: #0078d4; color: white; padding: 8px; font-weight: bold;")
         layout.addWidget(btn_close)
+
+    def on_rendered(self, html_content, error):
+        if error:
+            self.viewer.setPlainText(f"Error rendering Markdown: {error}\n\nOriginal text:\n{self.content}")
+            return
+        self.viewer.setHtml(f"<html><head><style>{STYLE}</style></head><body>{html_content}</body></html>")
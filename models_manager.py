@@ -1,12 +1,15 @@
 from PyQt6.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QTableView, QWidget,
-                             QPushButton, QHeaderView, QMessageBox, QLabel, QDoubleSpinBox, QItemDelegate, QComboBox, QGroupBox, QFrame)
+                             QPushButton, QHeaderView, QMessageBox, QLabel, QDoubleSpinBox, QSpinBox, QItemDelegate, QComboBox, QGroupBox, QFrame, QInputDialog)
 from PyQt6.QtSql import QSqlDatabase, QSqlTableModel
 from PyQt6.QtCore import Qt
 from PyQt6.QtGui import QFont
 from notes_manager import NotesManager
 from dotenv import load_dotenv
 import os
+from qasync import asyncSlot
 import db
+import db_writer
+from latency_sketch import LatencySketch
 
 class ModelsManager(QDialog):
     def __init__(self, db_path="chatlist.db", parent=None):
@@ -19,12 +22,18 @@ class ModelsManager(QDialog):
         self.init_ui()
         self.update_env_status() # Первичная валидация
         self.update_rating()     # Загрузка рейтинга
+        
+        # Синхронизация спинбоксов с изменениями настроек из других мест
+        db.subscribe_settings(self.on_setting_changed)
+        self.destroyed.connect(lambda: db.unsubscribe_settings(self.on_setting_changed))
 
     def init_db(self):
         # Проверяем, есть ли уже соединение
         if not QSqlDatabase.contains("qt_sql_default_connection"):
             self.db = QSqlDatabase.addDatabase("QSQLITE")
             self.db.setDatabaseName(self.db_path)
+            # Ждем снятия блокировки вместо мгновенного "database is locked" (файл делим с db.py)
+            self.db.setConnectOptions(f"QSQLITE_BUSY_TIMEOUT={db.BUSY_TIMEOUT_MS}")
             if not self.db.open():
                 QMessageBox.critical(self, "DB Error", "Could not open database via QtSql")
         else:
@@ -49,7 +58,8 @@ class ModelsManager(QDialog):
         # Секция глобальных настроек
         settings_layout = QHBoxLayout()
         delay_label = QLabel("Parallel Request Delay (sec):")
-        delay_label.setToolTip("Stagger concurrent requests to avoid 429 Too Many Requests errors.")
+        delay_label.setToolTip("Initial interval between requests to the same provider/key.\n"
+                               "Adapts automatically to 429 responses and rate-limit headers.")
         
         self.delay_spin = QDoubleSpinBox()
         self.delay_spin.setRange(0.0, 10.0)
@@ -73,6 +83,30 @@ class ModelsManager(QDialog):
         
         settings_layout.addWidget(timeout_label)
         settings_layout.addWidget(self.timeout_spin)
+        
+        concurrency_label = QLabel("  Max parallel / provider:")
+        self.concurrency_spin = QSpinBox()
+        self.concurrency_spin.setRange(0, 32)
+        self.concurrency_spin.setSpecialValueText("auto")
+        self.concurrency_spin.setToolTip("0 = auto: no limit until the provider answers 429 or x-ratelimit-*")
+        self.concurrency_spin.setValue(int(float(db.get_setting("provider_max_concurrency", 0))))
+        self.concurrency_spin.valueChanged.connect(lambda v: db.set_setting("provider_max_concurrency", v))
+        
+        settings_layout.addWidget(concurrency_label)
+        settings_layout.addWidget(self.concurrency_spin)
+        
+        hedge_label = QLabel("  Hedge after (sec):")
+        hedge_label.setToolTip("If a key has not answered within this time, fire the same request with the next key\n"
+                               "and take whichever answer comes first. 0 = off.")
+        self.hedge_spin = QDoubleSpinBox()
+        self.hedge_spin.setRange(0.0, 120.0)
+        self.hedge_spin.setSingleStep(1.0)
+        self.hedge_spin.setDecimals(1)
+        self.hedge_spin.setValue(float(db.get_setting("hedge_after", 0.0)))
+        self.hedge_spin.valueChanged.connect(lambda v: db.set_setting("hedge_after", v))
+        
+        settings_layout.addWidget(hedge_label)
+        settings_layout.addWidget(self.hedge_spin)
         settings_layout.addStretch()
         
         layout.addLayout(settings_layout)
@@ -129,9 +163,17 @@ class ModelsManager(QDialog):
         btn_notes = QPushButton("📝 Notes")
         btn_notes.clicked.connect(self.open_notes)
 
+        btn_clear_cache = QPushButton("🧹 Clear Response Cache")
+        btn_clear_cache.clicked.connect(self.clear_cache)
+
+        btn_price = QPushButton("💲 Set Price")
+        btn_price.clicked.connect(self.edit_price)
+
         btns_layout.addWidget(btn_add)
         btns_layout.addWidget(btn_delete)
         btns_layout.addWidget(btn_notes)
+        btns_layout.addWidget(btn_clear_cache)
+        btns_layout.addWidget(btn_price)
         btns_layout.addStretch()
         btns_layout.addWidget(btn_close)
         
@@ -167,6 +209,17 @@ class ModelsManager(QDialog):
     def save_timeout(self):
         db.set_setting("request_timeout", self.timeout_spin.value())
 
+    def on_setting_changed(self, key, value):
+        spin = {"request_delay": self.delay_spin, "request_timeout": self.timeout_spin,
+                "provider_max_concurrency": self.concurrency_spin, "hedge_after": self.hedge_spin}.get(key)
+        if spin is None:
+            return
+        value = int(float(value)) if isinstance(spin, QSpinBox) else float(value)
+        if spin.value() != value:
+            spin.blockSignals(True)
+            spin.setValue(value)
+            spin.blockSignals(False)
+
     def update_env_status(self):
         """Проверяет наличие ключей в .env и обновляет индикаторы."""
         load_dotenv(override=True) # Перезагружаем переменные окружения
@@ -210,15 +263,51 @@ class ModelsManager(QDialog):
                 self.rating_label.setText("No saved results yet.")
                 return
             
+            metrics = db.get_all_metrics()
             items = []
+            histograms = []
             for i, (name, count) in enumerate(rating):
                 medal = ["🥇", "🥈", "🥉", "▫️", "▫️"][i] if i < 5 else "▫️"
-                items.append(f"{medal} {name}: {count}")
+                m = metrics.get(name, {})
+                latency = f" (~{m['avg_time']}s, p90 {m['p90']}s)" if m.get("p90") else ""
+                items.append(f"{medal} {name}: {count}{latency}")
+                if m.get("histogram"):
+                    histograms.append(f"{name}: {LatencySketch.histogram_text(m['histogram'])}")
             
             self.rating_label.setText(" | ".join(items))
+            # Распределение времени ответа - во всплывающей подсказке
+            self.rating_label.setToolTip("\n".join(histograms))
         except Exception as e:
             self.rating_label.setText(f"Rating error: {e}")
 
+    @asyncSlot()
+    async def edit_price(self):
+        """Цена выбранной модели в $ за миллион токенов: prompt, completion[, cached]. Используется, если провайдер не сообщает стоимость."""
+        selected_index = self.table_view.currentIndex()
+        if not selected_index.isValid():
+            QMessageBox.warning(self, "Selection", "Please click on a model to set its price.")
+            return
+        model_name = self.model.data(self.model.index(selected_index.row(), 0))
+        price = db.get_model_price(model_name)
+        current = ", ".join("" if p is None else f"{p:g}" for p in price) if price else ""
+        text, ok = QInputDialog.getText(self, "Price", f"{model_name}: $ per 1M tokens (prompt, completion[, cached])",
+                                        text=current)
+        if not ok:
+            return
+        try:
+            values = [float(v) for v in text.replace(";", ",").split(",") if v.strip()]
+            if len(values) not in (2, 3):
+                raise ValueError("expected 2 or 3 numbers")
+        except ValueError as e:
+            QMessageBox.warning(self, "Price", f"Invalid price: {e}")
+            return
+        await db_writer.run(db.set_model_price, model_name, *values)
+
+    @asyncSlot()
+    async def clear_cache(self):
+        await db_writer.run(db.clear_response_cache)
+        QMessageBox.information(self, "Cache", "Response cache cleared.")
+
     def open_notes(self):
         notes = NotesManager(parent=self)
         notes.exec()
@@ -1,107 +1,552 @@
 import httpx
 import asyncio
+import contextlib
+import hashlib
+import json
 import logging
-import os
 import time
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 import db
+import db_writer
+import key_pool
+import scheduler
 
 logger = logging.getLogger(__name__)
 
+try:
+    import h2  # noqa: F401 - нужен httpx для HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Общие клиенты по хостам: одно пуловое соединение на провайдера вместо нового TLS на каждый запрос
+_clients = {}
+
+def _client_limits():
+    """Лимиты пула соединений из настроек."""
+    return httpx.Limits(
+        max_connections=int(float(db.get_setting("http_max_connections", 20))),
+        max_keepalive_connections=int(float(db.get_setting("http_max_keepalive", 10))),
+        keepalive_expiry=float(db.get_setting("http_keepalive_expiry", 30.0))
+    )
+
+def get_client(api_url):
+    """Возвращает общий httpx.AsyncClient для хоста api_url (создает при первом обращении)."""
+    parts = urlsplit(api_url)
+    host_key = f"{parts.scheme}://{parts.netloc}"
+    client = _clients.get(host_key)
+    if client is None or client.is_closed:
+        use_http2 = HTTP2_AVAILABLE and db.get_setting("http2_enabled", "1") == "1"
+        client = httpx.AsyncClient(http2=use_http2, limits=_client_limits())
+        _clients[host_key] = client
+        logger.info(f"Opened pooled HTTP client for {host_key} (http2={use_http2})")
+    return client
+
+async def close_clients():
+    """Закрывает все общие клиенты (вызывается при остановке цикла событий)."""
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.error(f"Error closing HTTP client: {e}")
+
+def _estimate_tokens(text):
+    """Грубая оценка числа токенов (≈4 символа на токен)."""
+    return max(1, len(text) // 4) if text else 0
+
+def _tokens_per_sec(completion_tokens, gen_time):
+    return round(completion_tokens / gen_time, 1) if completion_tokens and gen_time > 0 else 0.0
+
+async def _read_sse_stream(response, model_name, start_time, on_chunk=None):
+    """Читает SSE-поток (stream: true) и вызывает on_chunk с накопленным текстом на каждый фрагмент."""
+    content = ""
+    ttft = None
+    usage = None
+    # aclosing: при выходе из цикла ([DONE], ошибка) генератор закрывается здесь же, а не сборщиком мусора -
+    # под qasync нет хуков финализации async-генераторов, и httpcore ругался бы "ignored GeneratorExit"
+    async with contextlib.aclosing(response.aiter_lines()) as lines:
+        async for line in lines:
+            # Пустые строки и комментарии (": OPENROUTER PROCESSING") пропускаем
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            try:
+                event = json.loads(payload)
+            except ValueError:
+                continue
+
+            if event.get("error"):
+                elapsed = time.time() - start_time
+                logger.error(f"Stream error for {model_name}: {event['error']}")
+                return {"model": model_name, "response": content or str(event["error"]), "status": "Error: API",
+                        "resp_time": elapsed, "ttft": ttft, "tokens_per_sec": 0.0}
+            if event.get("usage"):
+                usage = event["usage"]
+
+            choices = event.get("choices") or []
+            piece = (choices[0].get("delta") or {}).get("content") if choices else None
+            if piece:
+                if ttft is None:
+                    ttft = time.time() - start_time
+                content += piece
+                if on_chunk:
+                    on_chunk(content)
+
+    elapsed = time.time() - start_time
+    if not content:
+        return {"model": model_name, "response": "Empty answer", "status": "Error: Parse",
+                "resp_time": elapsed, "ttft": ttft, "tokens_per_sec": 0.0}
+
+    completion_tokens = (usage or {}).get("completion_tokens") or _estimate_tokens(content)
+    return {"model": model_name, "response": content, "status": "Success", "resp_time": elapsed,
+            "ttft": ttft, "tokens_per_sec": _tokens_per_sec(completion_tokens, elapsed - ttft),
+            **parse_usage(usage)}
+
+def cached_tokens(usage):
+    """Число токенов промпта, взятых из кеша префикса провайдера (0, если провайдер не сообщил)."""
+    if not usage:
+        return 0
+    details = usage.get("prompt_tokens_details") or {}
+    # OpenAI/OpenRouter, DeepSeek, Anthropic
+    return int(details.get("cached_tokens") or usage.get("prompt_cache_hit_tokens")
+               or usage.get("cache_read_input_tokens") or 0)
+
+def parse_usage(usage):
+    """
+    Счетчики токенов из блока usage любого провайдера: prompt/completion/reasoning/cached_tokens
+    (None, если провайдер их не сообщил) и provider_cost, если провайдер сам посчитал стоимость (OpenRouter).
+    """
+    usage = usage or {}
+    completion_details = usage.get("completion_tokens_details") or {}
+    # OpenAI-совместимые поля, иначе имена Anthropic Messages API (там input_tokens не включает кеш)
+    prompt_tokens = usage.get("prompt_tokens")
+    if prompt_tokens is None and usage.get("input_tokens") is not None:
+        prompt_tokens = usage["input_tokens"] + (usage.get("cache_read_input_tokens") or 0) \
+            + (usage.get("cache_creation_input_tokens") or 0)
+    completion_tokens = usage.get("completion_tokens", usage.get("output_tokens"))
+    reasoning_tokens = completion_details.get("reasoning_tokens", usage.get("reasoning_tokens"))
+    cost = usage.get("cost")
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "reasoning_tokens": reasoning_tokens, "cached_tokens": cached_tokens(usage) if usage else None,
+            "provider_cost": cost if isinstance(cost, (int, float)) else None}
+
+# --- Кеширование префикса промпта у провайдеров ---
+# OpenAI и DeepSeek кешируют общий префикс сами, от провайдера нужен лишь стабильный порядок частей.
+# Anthropic и Gemini через OpenRouter кешируют только явно отмеченные блоки (cache_control).
+# Остальным (HF, z.ai, свои URL) промпт уходит в обычном порядке P1 -> P2 -> P3.
+
+PREFIX_CACHE_HOSTS = ("api.openai.com", "api.deepseek.com")
+
+EPHEMERAL_CACHE = {"type": "ephemeral"}
+
+def prefix_cache_enabled():
+    return db.get_setting("prefix_cache", "1") == "1"
+
+def _supports_cache_control(model_name, api_url):
+    return "openrouter.ai" in api_url and model_name.lower().startswith(("anthropic/", "google/gemini"))
+
+def caches_prefix(model_name, api_url):
+    """Кеширует ли провайдер модели префикс промпта (только таким моделям части переставляются)."""
+    if urlsplit(api_url).netloc in PREFIX_CACHE_HOSTS:
+        return True
+    if "openrouter.ai" in api_url and model_name.lower().startswith(("openai/", "deepseek/")):
+        return True
+    return _supports_cache_control(model_name, api_url)
+
+def reorders_prompt(model_name, api_url, p1, p2, p3):
+    """True, если модели уйдет переставленный промпт (P2+P3, затем P1)."""
+    return bool(p1 and (p2 or p3)) and prefix_cache_enabled() and caches_prefix(model_name, api_url)
+
+def sent_prompt(model_name, api_url, p1, p2, p3):
+    """Текст промпта в том порядке, в каком он уходит модели (для журнала, предпросмотра и экспорта)."""
+    order = (p2, p3, p1) if reorders_prompt(model_name, api_url, p1, p2, p3) else (p1, p2, p3)
+    return "\n\n".join(p for p in order if p)
+
+def build_prompt_messages(model_name, api_url, p1, p2, p3):
+    """
+    Тройной промпт в порядке, удобном для кеша префикса: стабильные контекст (P2) и формат (P3) впереди,
+    меняющаяся задача (P1) в конце. Для провайдеров с cache_control стабильная часть отмечается отдельным блоком.
+    """
+    stable = "\n\n".join(p for p in (p2, p3) if p)
+    if not stable or not p1:
+        return [{"role": "user", "content": stable or p1}]
+    if _supports_cache_control(model_name, api_url):
+        return [{"role": "user", "content": [{"type": "text", "text": stable, "cache_control": EPHEMERAL_CACHE},
+                                             {"type": "text", "text": p1}]}]
+    return [{"role": "user", "content": f"{stable}\n\n{p1}"}]
+
+def _with_cache_hints(messages):
+    """Отмечает для кеша system и последний ход истории перед новым вопросом (история сессии не мутируется)."""
+    marked = list(messages)
+    for i, message in enumerate(marked[:-1]):
+        if isinstance(message["content"], str) and (message["role"] == "system" or i == len(marked) - 2):
+            marked[i] = dict(message, content=[{"type": "text", "text": message["content"],
+                                                "cache_control": EPHEMERAL_CACHE}])
+    return marked
+
+# Коды, при которых имеет смысл попробовать запасной ключ
+RETRYABLE_STATUSES = (401, 429, 502, 503)
+
+def _api_error(model_name, status_code, error_text, start_time):
+    logger.error(f"API Error {status_code} for {model_name}: {error_text}")
+    return {"model": model_name, "response": f"Error {status_code}", "status": "Error: API",
+            "resp_time": time.time() - start_time}
+
+async def _send_request(model_name, api_url, api_key, headers, data, timeout, stream=False, on_chunk=None):
+    """
+    Один запрос к провайдеру в пределах его лимитов. Возвращает (HTTP-код, результат).
+    Время ответа отсчитывается после получения слота: ожидание в очереди лимитера - не задержка модели.
+    """
+    async with scheduler.limit(api_url, api_key) as limiter:
+        start_time = time.time()
+        client = get_client(api_url)
+        if stream:
+            async with client.stream("POST", api_url, headers=headers, json=data, timeout=float(timeout)) as response:
+                limiter.on_response(response.status_code, response.headers)
+                if response.status_code != 200:
+                    error_text = (await response.aread()).decode("utf-8", errors="replace")
+                    return response.status_code, _api_error(model_name, response.status_code, error_text, start_time)
+                return 200, await _read_sse_stream(response, model_name, start_time, on_chunk)
+
+        response = await client.post(api_url, headers=headers, json=data, timeout=float(timeout))
+        limiter.on_response(response.status_code, response.headers)
+        elapsed = time.time() - start_time
+        if response.status_code != 200:
+            return response.status_code, _api_error(model_name, response.status_code, response.text, start_time)
+
+        result = response.json()
+        content = result.get('choices', [{}])[0].get('message', {}).get('content')
+        
+        if content:
+            usage = result.get('usage')
+            completion_tokens = (usage or {}).get('completion_tokens') or _estimate_tokens(content)
+            return 200, {"model": model_name, "response": content, "status": "Success", "resp_time": elapsed,
+                         "tokens_per_sec": _tokens_per_sec(completion_tokens, elapsed),
+                         **parse_usage(usage)}
+        else:
+            return 200, {"model": model_name, "response": "Empty answer", "status": "Error: Parse", "resp_time": elapsed}
+
+def _build_headers(api_url, api_key):
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    
+    # Специфичные заголовки для OpenRouter
+    if "openrouter.ai" in api_url:
+        headers["HTTP-Referer"] = "https://github.com/antigravity/chatlist"
+        headers["X-Title"] = "ChatList AI Tool"
+    return headers
+
+def _build_payload(model_name, api_url, prompt, temperature, max_tokens, top_p, thinking, stream, messages=None):
+    data = {
+        "model": model_name,
+        "messages": messages or [{"role": "user", "content": prompt}],
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "top_p": top_p
+    }
+    if stream:
+        data["stream"] = True
+        if "api.openai.com" in api_url or "deepseek.com" in api_url:
+            # Без этого OpenAI и DeepSeek не присылают usage (и число кешированных токенов) в потоке
+            data["stream_options"] = {"include_usage": True}
+    if "openrouter.ai" in api_url:
+        # OpenRouter добавляет в usage фактическую стоимость запроса
+        data["usage"] = {"include": True}
+    if messages and len(messages) > 1 and prefix_cache_enabled() and _supports_cache_control(model_name, api_url):
+        data["messages"] = _with_cache_hints(messages)
+
+    # Специфичный блок для z.ai (GLM)
+    if "z.ai" in api_url:
+        data["model"] = model_name.lower()
+        if thinking:
+            data["thinking"] = {
+                "type": "enabled"
+            }
+    return data
+
+async def _attempt(pool, api_key, model_name, api_url, data, timeout, stream=False, on_chunk=None):
+    """Попытка с одним ключом; результат попытки учитывается в здоровье ключа. Возвращает (HTTP-код, результат)."""
+    attempt_start = time.time()
+    try:
+        status_code, result = await _send_request(model_name, api_url, api_key, _build_headers(api_url, api_key),
+                                                  data, timeout, stream, on_chunk)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        pool.report_failure(api_key)
+        raise
+    if status_code == 200:
+        pool.report_success(api_key, time.time() - attempt_start)
+    elif status_code in RETRYABLE_STATUSES:
+        limiter = scheduler.get_limiter(api_url, api_key)
+        pool.report_failure(api_key, status_code, max(0.0, limiter.blocked_until - time.monotonic()))
+    return status_code, result
+
+def _exception_result(model_name, error, start_time):
+    return {"model": model_name, "response": str(error), "status": "Error", "resp_time": time.time() - start_time}
+
+async def _hedged_fetch(keys, hedge_after, run_attempt, model_name, start_time):
+    """
+    Запускает запрос с первым ключом; если ответа нет за hedge_after сек или попытка сорвалась,
+    добавляет попытку со следующим ключом. Берет первый окончательный ответ, остальные попытки отменяет.
+    """
+    pending = {asyncio.ensure_future(run_attempt(keys[0]))}
+    next_key = 1
+    last_result = None
+    try:
+        while pending:
+            can_hedge = next_key < len(keys)
+            done, pending = await asyncio.wait(pending, timeout=hedge_after if can_hedge else None,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            failed = not done
+            for task in done:
+                try:
+                    status_code, result = task.result()
+                except Exception as e:
+                    last_result = _exception_result(model_name, e, start_time)
+                    failed = True
+                    continue
+                if status_code not in RETRYABLE_STATUSES:
+                    return result
+                last_result = result
+                failed = True
+            if failed and next_key < len(keys):
+                logger.info(f"Hedging {model_name} with key {next_key + 1}")
+                pending.add(asyncio.ensure_future(run_attempt(keys[next_key])))
+                next_key += 1
+    finally:
+        for task in pending:
+            task.cancel()
+    return last_result
+
+def make_cache_key(model_name, api_url, prompt, temperature, max_tokens, top_p, thinking, messages=None):
+    """Ключ кеша ответов: хеш модели, URL, промпта (или истории сообщений сессии) и параметров сэмплинга."""
+    raw = json.dumps([model_name, api_url, prompt, round(float(temperature), 4), int(max_tokens),
+                      round(float(top_p), 4), bool(thinking), messages], ensure_ascii=False)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=20).hexdigest()
+
+def _cache_limits():
+    ttl = float(db.get_setting("cache_ttl_hours", 24.0)) * 3600
+    max_bytes = int(float(db.get_setting("cache_max_mb", 50.0)) * 1024 * 1024)
+    return ttl, max_bytes
+
+class _Flight:
+    """Запрос в полете, общий для всех одинаковых вызовов: задача, число ожидающих и подписчики на фрагменты."""
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        self.chunk_listeners = []
+        self.last_chunk = None
+
+    def on_chunk(self, text):
+        self.last_chunk = text
+        for callback in list(self.chunk_listeners):
+            callback(text)
+
+# Single-flight: ключ запроса -> _Flight. Повторный идентичный вызов присоединяется к уже идущему запросу.
+_inflight = {}
+
 async def fetch_model_response(model_name, api_url, api_key_name, prompt, timeout=60, 
-                         temperature=0.7, max_tokens=2000, top_p=1.0, thinking=False):
+                         temperature=0.7, max_tokens=2000, top_p=1.0, thinking=False,
+                         stream=False, on_chunk=None, use_cache=False, messages=None, parts=None):
     """
     Отправляет асинхронный запрос к API конкретной модели с учетом глобальных параметров.
+    messages - готовый список сообщений (режим сессии); без него prompt уходит одним сообщением пользователя.
+    parts - (P1, P2, P3): при включенном prefix_cache промпт для провайдеров с кешем префикса собирается
+    из них в порядке для кеша; отправленный текст возвращается в full_prompt результата.
+    При stream=True ответ читается через SSE, а on_chunk получает накопленный текст по мере поступления.
+    Ключи берутся из пула провайдера: здоровые по кругу, ключи после 429 пропускаются до конца кулдауна.
+    При use_cache=True успешные ответы берутся из локального кеша и сохраняются в него.
+    Одинаковые запросы, уже находящиеся в полете, не отправляются повторно: все вызовы ждут один общий ответ.
     """
+    reordered = messages is None and parts is not None and reorders_prompt(model_name, api_url, *parts)
+    if reordered:
+        messages = build_prompt_messages(model_name, api_url, *parts)
+    key = make_cache_key(model_name, api_url, prompt, temperature, max_tokens, top_p, thinking, messages)
+    flight = _inflight.get(key)
+    if flight is None:
+        flight = _Flight()
+        flight.task = asyncio.ensure_future(_fetch_cached(
+            model_name, api_url, api_key_name, prompt, timeout, temperature, max_tokens, top_p, thinking,
+            stream, flight.on_chunk if stream else None, use_cache, messages))
+        _inflight[key] = flight
+        flight.task.add_done_callback(lambda _: _inflight.pop(key, None) if _inflight.get(key) is flight else None)
+    else:
+        logger.info(f"Joining in-flight request for {model_name}")
+        if on_chunk and flight.last_chunk is not None:
+            on_chunk(flight.last_chunk)
+
+    if on_chunk:
+        flight.chunk_listeners.append(on_chunk)
+    flight.waiters += 1
+    try:
+        # shield: отмена одного ожидающего не должна обрывать запрос, нужный остальным
+        result = await asyncio.shield(flight.task)
+    except asyncio.CancelledError:
+        if flight.waiters == 1:
+            flight.task.cancel()
+        raise
+    finally:
+        flight.waiters -= 1
+        if on_chunk in flight.chunk_listeners:
+            flight.chunk_listeners.remove(on_chunk)
+    # Копия: вызывающий код дополняет результат своими полями
+    result = dict(result)
+    if reordered:
+        result["full_prompt"] = sent_prompt(model_name, api_url, *parts)
+    return result
+
+async def _fetch_cached(model_name, api_url, api_key_name, prompt, timeout, temperature, max_tokens,
+                        top_p, thinking, stream, on_chunk, use_cache, messages=None):
+    if not use_cache:
+        return await _fetch_uncached(model_name, api_url, api_key_name, prompt, timeout, temperature,
+                                     max_tokens, top_p, thinking, stream, on_chunk, messages)
+
+    cache_key = make_cache_key(model_name, api_url, prompt, temperature, max_tokens, top_p, thinking, messages)
+    ttl, max_bytes = _cache_limits()
+    # Чтение без блокировки записи: GUI-поток не ждет поток записи
+    cached, expired = db.get_cached_response(cache_key, ttl)
+    if expired:
+        db_writer.submit(db.expire_cached_response, cache_key, ttl)
+    elif cached is not None:
+        db_writer.submit(db.touch_cached_response, cache_key, time.time())
+        logger.info(f"Cache hit for {model_name}")
+        # Ожидания не было: resp_time=0 не искажает метрики задержки при сохранении
+        # provider_cost=0: повторный ответ из кеша ничего не стоит
+        cached.update({"model": model_name, "status": "Success (cached)", "resp_time": 0.0, "cached": True,
+                       "provider_cost": 0.0})
+        return cached
+
+    result = await _fetch_uncached(model_name, api_url, api_key_name, prompt, timeout, temperature,
+                                   max_tokens, top_p, thinking, stream, on_chunk, messages)
+    if result.get("status") == "Success":
+        # Запись в кеш не задерживает ответ: идет в фоновом потоке записи
+        db_writer.submit(db.put_cached_response, cache_key, model_name, dict(result), ttl, max_bytes)
+    return result
+
+async def _fetch_uncached(model_name, api_url, api_key_name, prompt, timeout, temperature, max_tokens,
+                          top_p, thinking, stream, on_chunk, messages=None):
     load_dotenv()
     start_time = time.time()
     
-    # Логика выбора ключей (ротация)
-    api_keys = []
-    if api_key_name == "OPENROUTER_API_KEY":
-        k1 = os.getenv("OPENROUTER_API_KEY")
-        k2 = os.getenv("OPENROUTER_API_KEY2")
-        if k1: api_keys.append(k1)
-        if k2: api_keys.append(k2)
-    elif api_key_name in ["HF_API_KEY", "HF_TOKEN"]:
-        k = os.getenv("HF_API_KEY") or os.getenv("HF_TOKEN")
-        if k: api_keys.append(k)
-    elif api_key_name == "ZAI_API_KEY":
-        k = os.getenv("ZAI_API_KEY")
-        if k: api_keys.append(k)
-    else:
-        k = os.getenv(api_key_name)
-        if k: api_keys.append(k)
-
+    pool = key_pool.get_pool(api_key_name)
+    api_keys = pool.ordered()
     if not api_keys:
         return {"model": model_name, "response": "API key not found", "status": "Error: Auth", "resp_time": 0.0}
 
-    last_error = ""
-    for i, api_key in enumerate(api_keys):
-        # Экспоненциальная выдержка перед переключением на запасной ключ (если попытка не первая)
-        if i > 0:
-            wait_time = 2 ** i 
-            logger.info(f"Waiting {wait_time}s before switching to backup key for {model_name}...")
-            await asyncio.sleep(wait_time)
-
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        # Специфичные заголовки для OpenRouter
-        if "openrouter.ai" in api_url:
-            headers["HTTP-Referer"] = "https://github.com/antigravity/chatlist"
-            headers["X-Title"] = "ChatList AI Tool"
-
-        data = {
-            "model": model_name,
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-            "top_p": top_p
-        }
-
-        # Специфичный блок для z.ai (GLM)
-        if "z.ai" in api_url:
-            data["model"] = model_name.lower()
-            if thinking:
-                data["thinking"] = {
-                    "type": "enabled"
-                }
+    data = _build_payload(model_name, api_url, prompt, temperature, max_tokens, top_p, thinking, stream, messages)
+
+    def run_attempt(api_key):
+        return _attempt(pool, api_key, model_name, api_url, data, timeout, stream, on_chunk)
+
+    # Хеджирование: запасной ключ стартует, если первый не ответил за hedge_after сек.
+    # В потоковом режиме не используется, чтобы две попытки не писали фрагменты в одну строку.
+    hedge_after = float(db.get_setting("hedge_after", 0.0))
+    if hedge_after > 0 and len(api_keys) > 1 and not stream:
+        return await _hedged_fetch(api_keys, hedge_after, run_attempt, model_name, start_time)
 
+    result = None
+    for i, api_key in enumerate(api_keys):
         try:
-            async with httpx.AsyncClient(timeout=float(timeout)) as client:
-                response = await client.post(api_url, headers=headers, json=data)
-                elapsed = time.time() - start_time
-                
-                # Ротация при ошибках или лимитах (401, 429, 502, 503)
-                if response.status_code in [401, 429, 502, 503] and i < len(api_keys) - 1:
-                    logger.warning(f"Key {i+1} failed ({response.status_code}) for {model_name}. Switching...")
-                    continue
-                
-                if response.status_code != 200:
-                    error_text = response.text
-                    logger.error(f"API Error {response.status_code} for {model_name}: {error_text}")
-                    return {"model": model_name, "response": f"Error {response.status_code}", "status": "Error: API", "resp_time": elapsed}
-
-                result = response.json()
-                content = result.get('choices', [{}])[0].get('message', {}).get('content')
-                
-                if content:
-                    return {"model": model_name, "response": content, "status": "Success", "resp_time": elapsed}
-                else:
-                    return {"model": model_name, "response": "Empty answer", "status": "Error: Parse", "resp_time": elapsed}
-                    
+            status_code, result = await run_attempt(api_key)
         except Exception as e:
-            elapsed = time.time() - start_time
-            last_error = str(e)
+            result = _exception_result(model_name, e, start_time)
             if i < len(api_keys) - 1:
-                logger.error(f"Attempt {i+1} for {model_name} failed: {last_error}. Trying next key...")
+                logger.error(f"Attempt {i+1} for {model_name} failed: {e}. Trying next key...")
+            continue
+        # Ротация при ошибках или лимитах (401, 429, 502, 503) - сразу, без паузы: ключ уже в кулдауне пула
+        if status_code in RETRYABLE_STATUSES and i < len(api_keys) - 1:
+            logger.warning(f"Key {i+1} failed ({status_code}) for {model_name}. Switching...")
+            continue
+        return result
+
+    return result
+
+class FanoutRun:
+    """
+    Запущенная рассылка одного промпта по нескольким моделям. Позволяет отменить все запросы или один по ключу,
+    ограничить всю рассылку общим дедлайном и остановиться после первых stop_after успешных ответов.
+    Отмена задачи сразу закрывает ее HTTP-поток и освобождает слот лимитера провайдера.
+    """
+    def __init__(self, deadline=0.0, stop_after=0):
+        self.deadline = deadline
+        self.stop_after = stop_after
+        self.tasks = {}
+        self.models = {}
+        self.successes = 0
+        self.reason = None
+        self.start_time = time.time()
+
+    def add(self, key, model_name, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks[key] = task
+        self.models[key] = model_name
+        return task
+
+    def is_running(self, key):
+        task = self.tasks.get(key)
+        return task is not None and not task.done()
+
+    def cancel(self, key):
+        """Отменяет один запрос; True, если он еще выполнялся."""
+        if not self.is_running(key):
+            return False
+        self.tasks[key].cancel()
+        return True
+
+    def cancel_all(self, reason="stopped"):
+        if self.reason is None:
+            self.reason = reason
+        for task in self.tasks.values():
+            if not task.done():
+                task.cancel()
+
+    def _cancelled_result(self, key):
+        status = f"Cancelled ({self.reason})" if self.reason else "Cancelled"
+        return {"model": self.models[key], "response": "", "status": status,
+                "resp_time": time.time() - self.start_time}
+
+    async def results(self):
+        """Асинхронно выдает (ключ, результат) по мере завершения; отмененные запросы дают статус Cancelled."""
+        keys = {task: key for key, task in self.tasks.items()}
+        pending = set(keys)
+        deadline_at = time.monotonic() + self.deadline if self.deadline > 0 else None
+        while pending:
+            timeout = None
+            if deadline_at is not None and self.reason is None:
+                timeout = max(0.0, deadline_at - time.monotonic())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.info(f"Fan-out deadline of {self.deadline:.0f}s reached, cancelling {len(pending)} requests")
+                self.cancel_all("deadline")
                 continue
-            break
+            for task in done:
+                key = keys[task]
+                if task.cancelled():
+                    result = self._cancelled_result(key)
+                elif task.exception() is not None:
+                    result = _exception_result(self.models[key], task.exception(), self.start_time)
+                else:
+                    result = task.result()
+                if result.get("status", "").startswith("Success"):
+                    self.successes += 1
+                    if self.stop_after and self.successes >= self.stop_after and pending:
+                        logger.info(f"Got {self.successes} successful answers, cancelling the rest")
+                        self.cancel_all(f"first {self.stop_after} done")
+                yield key, result
 
-    return {"model": model_name, "response": last_error, "status": "Error", "resp_time": elapsed}
+def _run_limits():
+    """Общий дедлайн рассылки (сек, 0 - без него) и число успешных ответов для ранней остановки (0 - ждать все)."""
+    deadline = float(db.get_setting("run_deadline", 0.0))
+    stop_after = int(float(db.get_setting("run_stop_after", 0)))
+    return deadline, stop_after
 
 async def delayed_fetch(delay, model_name, api_url, api_key_name, prompt, timeout=60, **kwargs):
     """Вспомогательная функция для ступенчатого запуска запросов."""
@@ -110,11 +555,14 @@ async def delayed_fetch(delay, model_name, api_url, api_key_name, prompt, timeou
     return await fetch_model_response(model_name, api_url, api_key_name, prompt, timeout, **kwargs)
 
 async def send_parallel_prompts(active_models, prompt):
-    """Отправляет промт одновременно во все активные модели с учетом задержки."""
-    delay_step = float(db.get_setting("request_delay", 0.0))
-    tasks = []
+    """
+    Отправляет промт одновременно во все активные модели; темп по каждому провайдеру задает scheduler.
+    Учитывает общий дедлайн и раннюю остановку из настроек; результаты - в порядке active_models.
+    """
+    run = FanoutRun(*_run_limits())
     for i, m in enumerate(active_models):
-        # Первый запрос уходит сразу, каждый последующий - с шагом задержки
-        tasks.append(delayed_fetch(i * delay_step, m[0], m[1], m[2], prompt))
-    
-    return await asyncio.gather(*tasks)
+        run.add(i, m[0], fetch_model_response(m[0], m[1], m[2], prompt))
+    results = [None] * len(active_models)
+    async for i, result in run.results():
+        results[i] = result
+    return results
@@ -3,9 +3,45 @@ from PyQt6.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QTableView,
                              QPushButton, QHeaderView, QMessageBox, QLabel, 
                              QLineEdit, QTextEdit, QFormLayout, QWidget)
 from PyQt6.QtSql import QSqlDatabase, QSqlTableModel
-from PyQt6.QtCore import Qt, QDateTime
+from PyQt6.QtCore import Qt, QDateTime, QTimer
 import db
 
+class RankedNotesModel(QSqlTableModel):
+    """
+    Таблица заметок; при поиске строки идут в порядке релевантности (ранжирование bm25 из db.search_notes),
+    а в колонке текста показывается найденный фрагмент с подсвеченными совпадениями.
+    """
+    SNIPPET_COLUMN = 4
+
+    def __init__(self, parent, database):
+        super().__init__(parent, database)
+        self.ranked_ids = None
+        self.snippets = {}
+
+    def set_search_results(self, results):
+        """results - [(id, фрагмент)] из db.search_notes или None (поиск сброшен)."""
+        self.ranked_ids = [int(note_id) for note_id, _ in results] if results is not None else None
+        self.snippets = {int(note_id): snippet for note_id, snippet in results or []}
+        if self.ranked_ids is None:
+            self.setFilter("")
+        else:
+            self.setFilter(f"id IN ({', '.join(map(str, self.ranked_ids))})" if self.ranked_ids else "0")
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        # Только показ: EditRole (его читает редактор заметки) возвращает полный текст
+        if self.snippets and index.column() == self.SNIPPET_COLUMN and role in (
+                Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.ToolTipRole):
+            snippet = self.snippets.get(super().data(self.index(index.row(), 0)))
+            if snippet is not None:
+                return " ".join(snippet.split())
+        return super().data(index, role)
+
+    def orderByClause(self):
+        if not self.ranked_ids:
+            return super().orderByClause()
+        cases = " ".join(f"WHEN {note_id} THEN {rank}" for rank, note_id in enumerate(self.ranked_ids))
+        return f"ORDER BY CASE id {cases} END"
+
 class NotesManager(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -19,12 +55,13 @@ class NotesManager(QDialog):
         if not QSqlDatabase.contains("qt_sql_default_connection"):
             self.db = QSqlDatabase.addDatabase("QSQLITE")
             self.db.setDatabaseName("chatlist.db")
+            self.db.setConnectOptions(f"QSQLITE_BUSY_TIMEOUT={db.BUSY_TIMEOUT_MS}")
             if not self.db.open():
                 QMessageBox.critical(self, "DB Error", "Could not open database via QtSql")
         else:
             self.db = QSqlDatabase.database("qt_sql_default_connection")
 
-        self.model = QSqlTableModel(self, self.db)
+        self.model = RankedNotesModel(self, self.db)
         self.model.setTable("notes")
         self.model.setEditStrategy(QSqlTableModel.EditStrategy.OnFieldChange)
         
@@ -49,7 +86,11 @@ class NotesManager(QDialog):
         self.search_input = QLineEdit()
         self.search_input.setPlaceholderText("🔍 Поиск по содержанию / тегам...")
         self.search_input.setFixedWidth(250)
-        self.search_input.textChanged.connect(self.update_search_filter)
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(250)
+        self.search_timer.timeout.connect(lambda: self.update_search_filter(self.search_input.text()))
+        self.search_input.textChanged.connect(self.search_timer.start)
         top_layout.addWidget(self.search_input)
         
         top_layout.addStretch()
@@ -129,7 +170,7 @@ class NotesManager(QDialog):
             self.date_edit.setText(self.model.index(row, 1).data())
             self.tag_edit.setText(self.model.index(row, 2).data())
             self.title_edit.setText(self.model.index(row, 3).data())
-            self.content_edit.setPlainText(self.model.index(row, 4).data())
+            self.content_edit.setPlainText(self.model.index(row, 4).data(Qt.ItemDataRole.EditRole))
         else:
             self.clear_edits()
 
@@ -167,12 +208,13 @@ class NotesManager(QDialog):
             self.clear_edits()
 
     def update_search_filter(self, text):
-        """Фильтрация заметок по вводу."""
-        if not text:
-            self.model.setFilter("")
-        else:
-            # Простейшее экранирование для предотвращения ошибок SQL при вводе '
-            safe_text = text.replace("'", "''")
-            filter_str = f"(content LIKE '%{safe_text}%' OR title LIKE '%{safe_text}%' OR tag LIKE '%{safe_text}%')"
-            self.model.setFilter(filter_str)
+        """
+        Фильтрация заметок по вводу через полнотекстовый индекс (ввод пользователя в SQL не подставляется).
+        Найденные заметки показываются от самых релевантных, с фрагментом совпадения.
+        """
+        searching = bool(text.strip())
+        self.model.set_search_results(db.search_notes(text) if searching else None)
         self.model.select()
+        # Во время поиска колонка текста показывает найденные фрагменты
+        self.table_view.setColumnHidden(4, not searching)
+        self.model.setHeaderData(4, Qt.Orientation.Horizontal, "Совпадение" if searching else "Текст")
@@ -1,10 +1,28 @@
 from PyQt6.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QTableView, 
                              QPushButton, QHeaderView, QMessageBox, QLabel, QLineEdit, QAbstractItemView, QItemDelegate, QComboBox)
-from PyQt6.QtSql import QSqlDatabase, QSqlTableModel
-from PyQt6.QtCore import Qt, QSortFilterProxyModel
+from PyQt6.QtCore import Qt, QTimer
+from qasync import asyncSlot
 from notes_manager import NotesManager
 from md_viewer import MarkdownViewer
+from table_models import ResultsPageModel
 import db
+import db_writer
+
+def format_cost(cost):
+    return f"${cost:.4f}" if cost is not None else "—"
+
+def usage_table(title, key_title, rows):
+    """Markdown-таблица сводки расхода (строки из db.get_usage_by_*)."""
+    lines = [f"### {title}", "",
+             f"| {key_title} | Results | Prompt tok | Completion tok | Reasoning tok | Cached tok | Cost | tok/s |",
+             "|---|---|---|---|---|---|---|---|"]
+    for row in rows:
+        speed = f"{row['tokens_per_sec']:.1f}" if row['tokens_per_sec'] else "—"
+        lines.append(f"| {row['key']} | {row['results']} | {row['prompt_tokens'] or 0} | {row['completion_tokens'] or 0} "
+                     f"| {row['reasoning_tokens'] or 0} | {row['cached_tokens'] or 0} | {format_cost(row['cost'])} | {speed} |")
+    if not rows:
+        lines.append("| — | 0 | 0 | 0 | 0 | 0 | — | — |")
+    return "\n".join(lines)
 
 class ResultsJournal(QDialog):
     def __init__(self, db_path="chatlist.db", parent=None):
@@ -18,32 +36,9 @@ class ResultsJournal(QDialog):
         self.init_ui()
 
     def init_db(self):
-        if not QSqlDatabase.contains("qt_sql_default_connection"):
-            self.db = QSqlDatabase.addDatabase("QSQLITE")
-            self.db.setDatabaseName(self.db_path)
-            if not self.db.open():
-                QMessageBox.critical(self, "DB Error", "Could not open database via QtSql")
-        else:
-            self.db = QSqlDatabase.database("qt_sql_default_connection")
-
-        self.model = QSqlTableModel(self, self.db)
-        self.model.setTable("results")
-        self.model.setEditStrategy(QSqlTableModel.EditStrategy.OnFieldChange)
-        
-        # Headers: id, prompt_id, model_name, response, date, full_prompt
-        self.model.setHeaderData(0, Qt.Orientation.Horizontal, "ID")
-        self.model.setHeaderData(1, Qt.Orientation.Horizontal, "Prompt ID")
-        self.model.setHeaderData(2, Qt.Orientation.Horizontal, "Model")
-        self.model.setHeaderData(3, Qt.Orientation.Horizontal, "Response")
-        self.model.setHeaderData(4, Qt.Orientation.Horizontal, "Date")
-        self.model.setHeaderData(5, Qt.Orientation.Horizontal, "Prompt Content")
-        
-        self.model.select()
-
-        self.proxy_model = QSortFilterProxyModel()
-        self.proxy_model.setSourceModel(self.model)
-        self.proxy_model.setFilterKeyColumn(-1)
-        self.proxy_model.setFilterCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+        # Страницы журнала читаются из SQLite по мере прокрутки, поиск выполняется в БД
+        self.model = ResultsPageModel(self)
+        self.model.refresh()
 
     def init_ui(self):
         layout = QVBoxLayout(self)
@@ -54,8 +49,13 @@ class ResultsJournal(QDialog):
         title.setStyleSheet("font-size: 18px; font-weight: bold; color: #3b82f6;")
         
         self.search_input = QLineEdit()
-        self.search_input.setPlaceholderText("🔍 Filter results...")
-        self.search_input.textChanged.connect(self.proxy_model.setFilterFixedString)
+        self.search_input.setPlaceholderText("🔍 Search responses and prompts...")
+        # Поиск запускается после паузы в наборе, а не на каждую букву
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(250)
+        self.search_timer.timeout.connect(lambda: self.model.set_query(self.search_input.text()))
+        self.search_input.textChanged.connect(self.search_timer.start)
         self.search_input.setMaximumWidth(300)
 
         header_row.addWidget(title)
@@ -64,8 +64,8 @@ class ResultsJournal(QDialog):
         layout.addLayout(header_row)
 
         self.table_view = QTableView()
-        self.table_view.setModel(self.proxy_model)
-        self.table_view.setSortingEnabled(True)
+        # Порядок задан пагинацией (новые сверху), сортировка загруженной части ввела бы в заблуждение
+        self.table_view.setModel(self.model)
         self.table_view.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
         self.table_view.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
         self.table_view.doubleClicked.connect(self.on_double_clicked)
@@ -96,7 +96,7 @@ class ResultsJournal(QDialog):
         btn_open.setStyleSheet("background-color: #2563eb; color: white;")
 
         btn_refresh = QPushButton("🔄 Refresh")
-        btn_refresh.clicked.connect(self.model.select)
+        btn_refresh.clicked.connect(self.model.refresh)
 
         btn_close = QPushButton("Close")
         btn_close.clicked.connect(self.accept)
@@ -104,24 +104,34 @@ class ResultsJournal(QDialog):
         btn_notes = QPushButton("📝 Notes")
         btn_notes.clicked.connect(self.open_notes)
 
+        btn_usage = QPushButton("📈 Usage")
+        btn_usage.clicked.connect(self.show_usage)
+
         btns_layout.addWidget(btn_delete)
         btns_layout.addWidget(btn_open)
         btns_layout.addWidget(btn_refresh)
         btns_layout.addWidget(btn_notes)
+        btns_layout.addWidget(btn_usage)
         btns_layout.addStretch()
         btns_layout.addWidget(btn_close)
         
         layout.addLayout(btns_layout)
 
-    def delete_row(self):
+    @asyncSlot()
+    async def delete_row(self):
         selected_index = self.table_view.currentIndex()
         if selected_index.isValid():
-            source_index = self.proxy_model.mapToSource(selected_index)
+            row = selected_index.row()
+            result_id = self.model.result_id(row)
             confirm = QMessageBox.question(self, "Delete Result", "Delete this saved response permanently?",
                                          QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
             if confirm == QMessageBox.StandardButton.Yes:
-                self.model.removeRow(source_index.row())
-                self.model.select()
+                await db_writer.run(db.delete_result, result_id)
+                # Пока шла запись, страница могла обновиться: строку ищем заново по ID
+                row = next((r for r in range(self.model.rowCount()) if self.model.result_id(r) == result_id), None)
+                if row is not None:
+                    self.model.remove_row(row)
+                self.update_stats()
         else:
             QMessageBox.warning(self, "Selection", "Please select a row to delete.")
 
@@ -133,10 +143,12 @@ class ResultsJournal(QDialog):
             QMessageBox.warning(self, "Selection", "Please select a response to view.")
 
     def on_double_clicked(self, index):
-        source_index = self.proxy_model.mapToSource(index)
-        row = source_index.row()
-        model_name = self.model.index(row, 2).data()
-        response_text = self.model.index(row, 3).data()
+        # В таблице только превью: полный ответ читается при открытии
+        found = db.get_result_response(self.model.result_id(index.row()))
+        if found is None:
+            QMessageBox.warning(self, "Not Found", "This result no longer exists.")
+            return
+        model_name, response_text = found
         
         viewer = MarkdownViewer(model_name, response_text, self)
         viewer.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
@@ -145,21 +157,29 @@ class ResultsJournal(QDialog):
         viewer.raise_()
 
     def update_stats(self):
-        """Подсчет рейтинга моделей по количеству сохраненных записей."""
-        counts = {}
-        for row in range(self.model.rowCount()):
-            # Индекс 2 - это model_name
-            m_name = self.model.index(row, 2).data()
-            if m_name:
-                counts[m_name] = counts.get(m_name, 0) + 1
+        """Рейтинг моделей по количеству сохраненных записей (из агрегатов model_stats)."""
+        top = db.get_model_popularity_rating(limit=5)
         
-        if not counts:
+        if not top:
             self.stats_label.setText("📊 Статистика: сохраненных ответов пока нет.")
             return
 
-        sorted_stats = sorted(counts.items(), key=lambda x: x[1], reverse=True)
-        top_str = " | ".join([f"🏆 {name}: {count}" for name, count in sorted_stats[:5]])
-        self.stats_label.setText(f"🔥 Рейтинг моделей (ТОП-5): {top_str}")
+        top_str = " | ".join([f"🏆 {name}: {count}" for name, count in top])
+        days = db.get_usage_by_day(limit=1)
+        spent = f"  💰 {days[0]['key']}: {format_cost(days[0]['cost'])}" if days else ""
+        self.stats_label.setText(f"🔥 Рейтинг моделей (ТОП-5): {top_str}{spent}")
+
+    def show_usage(self):
+        """Отчет о расходе токенов и стоимости по запускам, моделям и дням (Markdown-таблицы)."""
+        report = "\n\n".join([
+            usage_table("Запуски", "Run", db.get_usage_by_run()),
+            usage_table("Модели", "Model", db.get_usage_by_model()),
+            usage_table("Дни", "Day", db.get_usage_by_day()),
+        ])
+        viewer = MarkdownViewer("Usage", report, self)
+        viewer.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
+        self.viewer_windows.append(viewer)
+        viewer.show()
 
     def open_notes(self):
         notes = NotesManager(parent=self)
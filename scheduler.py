@@ -0,0 +1,180 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import db
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENCY = 0  # 0 - без ограничения, пока провайдер сам не попросит сбавить
+DEFAULT_BURST = 32
+
+class ProviderLimiter:
+    """
+    Лимитер одного провайдера и ключа: token bucket ограничивает темп, окно - число одновременных запросов.
+    Оба подстраиваются по ответам (AIMD): 429 вдвое снижает темп и окно, успешные ответы понемногу поднимают.
+    Пока провайдер не ответил 429 или x-ratelimit-*, окно не ограничено (или ограничено max_concurrency > 0).
+    """
+    MIN_RATE = 0.05   # запросов/сек
+    MAX_RATE = 50.0
+    RATE_STEP = 0.05  # прирост темпа за успешный ответ
+
+    def __init__(self, rate, burst, max_concurrency=0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.max_concurrency = max_concurrency  # потолок из настроек, 0 - нет
+        self.window = max_concurrency or None   # текущее окно, None - без ограничения
+        self.in_flight = 0
+        self._slot_freed = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    def _has_slot(self):
+        return self.window is None or self.in_flight < self.window
+
+    def _set_window(self, window):
+        if window is not None and self.max_concurrency:
+            window = min(window, self.max_concurrency)
+        self.window = window
+        self._slot_freed.set()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while not self._has_slot():
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+        self.in_flight += 1
+        try:
+            # Под блокировкой ожидающие обслуживаются по очереди (FIFO)
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    if now < self.blocked_until:
+                        await asyncio.sleep(self.blocked_until - now)
+                        continue
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._slot_freed.set()
+
+    def on_response(self, status_code, headers):
+        """Учитывает код ответа и заголовки Retry-After / x-ratelimit-*."""
+        now = time.monotonic()
+        retry_after = parse_retry_after(headers)
+        remaining, reset = parse_rate_limit(headers)
+        if status_code == 429:
+            self.rate = max(self.MIN_RATE, self.rate / 2)
+            self.tokens = 0.0
+            self.blocked_until = max(self.blocked_until, now + (retry_after or reset or 1.0))
+            self._set_window(max(1, (self.window or self.in_flight) // 2))
+            logger.warning(f"Rate limited, backing off: rate={self.rate:.2f}/s, window={self.window}, "
+                           f"pause={self.blocked_until - now:.1f}s")
+        elif 200 <= status_code < 300:
+            if remaining is not None and remaining <= 0 and reset:
+                # Квота окна исчерпана: ждем ее сброса, не дожидаясь 429
+                self.blocked_until = max(self.blocked_until, now + reset)
+            else:
+                self.rate = min(self.MAX_RATE, self.rate + self.RATE_STEP)
+                if remaining is not None and remaining < self.in_flight:
+                    # Запросов в полете больше, чем осталось квоты: не отправляем лишние
+                    self._set_window(max(1, remaining))
+                elif self.window is not None and self.window != self.max_concurrency:
+                    self._set_window(self.window + 1)
+
+def _parse_duration(value):
+    """'1s', '6m0s', '20ms', '1.5' -> секунды."""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    return sum(float(n) * units[u] for n, u in parts) if parts else None
+
+def parse_retry_after(headers):
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    seconds = _parse_duration(value)
+    if seconds is not None:
+        return seconds
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def parse_rate_limit(headers):
+    """Возвращает (оставшиеся запросы, секунд до сброса окна) из заголовков OpenAI/Groq/OpenRouter."""
+    remaining = headers.get("x-ratelimit-remaining-requests") or headers.get("x-ratelimit-remaining")
+    reset = headers.get("x-ratelimit-reset-requests") or headers.get("x-ratelimit-reset")
+    try:
+        remaining = int(float(remaining)) if remaining is not None else None
+    except ValueError:
+        remaining = None
+    reset_seconds = None
+    if reset:
+        number = _parse_duration(reset)
+        if number is not None:
+            # OpenRouter отдает момент сброса в epoch-миллисекундах
+            if number > 1e12:
+                number = number / 1000 - time.time()
+            elif number > 1e9:
+                number = number - time.time()
+            reset_seconds = max(0.0, number)
+    return remaining, reset_seconds
+
+_limiters = {}
+
+def _limiter_key(api_url, api_key):
+    host = urlsplit(api_url).netloc
+    key_id = hashlib.blake2b((api_key or "").encode("utf-8"), digest_size=6).hexdigest()
+    return host, key_id
+
+def get_limiter(api_url, api_key):
+    """Лимитер для пары (хост, ключ). Начальный темп берется из request_delay, дальше подстраивается."""
+    key = _limiter_key(api_url, api_key)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        delay = float(db.get_setting("request_delay", 0.0))
+        max_concurrency = int(float(db.get_setting("provider_max_concurrency", DEFAULT_MAX_CONCURRENCY)))
+        if delay > 0:
+            limiter = ProviderLimiter(1.0 / delay, 1, max_concurrency)
+        else:
+            limiter = ProviderLimiter(ProviderLimiter.MAX_RATE, max(max_concurrency, DEFAULT_BURST), max_concurrency)
+        _limiters[key] = limiter
+    return limiter
+
+@asynccontextmanager
+async def limit(api_url, api_key):
+    """Слот на запрос к провайдеру: ждет свою очередь по лимитам пары (хост, ключ)."""
+    limiter = get_limiter(api_url, api_key)
+    await limiter.acquire()
+    try:
+        yield limiter
+    finally:
+        limiter.release()
+
+def _on_setting_changed(key, value):
+    # Новые начальные параметры применяются к следующим запросам
+    if key in ("request_delay", "provider_max_concurrency"):
+        _limiters.clear()
+
+db.subscribe_settings(_on_setting_changed)
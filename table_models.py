@@ -1,10 +1,58 @@
-from PyQt6.QtCore import Qt, QAbstractTableModel
+from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex
 from PyQt6.QtGui import QColor
+import db
+from latency_sketch import LatencySketch
+
+class RowDisplay:
+    """Готовые к показу поля строки результатов: считаются один раз при получении или правке ответа."""
+    __slots__ = ("preview", "symbols", "tokens", "metrics")
+
+    def __init__(self, item):
+        resp = item['response']
+        lines = resp.split('\n', 3)
+        if len(lines) > 3:
+            self.preview = "\n".join(lines[:3]) + "..."
+        else:
+            self.preview = (resp[:200] + '...') if len(resp) > 200 else resp
+        self.symbols = str(len(resp))
+        # Грубая оценка (≈4 символа на токен), как в network
+        self.tokens = max(1, len(resp) // 4) if resp else 0
+        self.metrics = _metrics_text(item)
+
+def _metrics_text(item):
+    status = item['status']
+    t = item.get('resp_time', 0)
+    metrics = item.get('metrics', {})
+    avg = metrics.get('avg_time', 0)
+    std = metrics.get('std_time', 0)
+    errs = metrics.get('errors', 0)
+    
+    info = f"[{status}]"
+    if t > 0: info += f" {t:.1f}s"
+    ttft = item.get('ttft')
+    if ttft: info += f" TTFT:{ttft:.1f}s"
+    tps = item.get('tokens_per_sec')
+    if tps: info += f" {tps:.0f} tok/s"
+    prompt_tokens, completion_tokens = item.get('prompt_tokens'), item.get('completion_tokens')
+    if prompt_tokens or completion_tokens:
+        info += f" in/out:{prompt_tokens or 0}/{completion_tokens or 0} tok"
+    cached = item.get('cached_tokens')
+    if cached: info += f" cache:{cached} tok"
+    cost = item.get('cost')
+    if cost: info += f" ${cost:.4f}"
+    if avg > 0 or errs > 0:
+        info += f" (Avg:{avg}±{std}s | Err:{errs})" if std else f" (Avg:{avg}s | Err:{errs})"
+    if metrics.get('p90'):
+        info += f" p50/p90/p99: {metrics['p50']}/{metrics['p90']}/{metrics['p99']}s"
+    if metrics.get('ttft_p90'):
+        info += f" TTFT p50/p90: {metrics['ttft_p50']}/{metrics['ttft_p90']}s"
+    return info
 
 class ResultsTableModel(QAbstractTableModel):
     def __init__(self, data=None):
         super().__init__()
         self._data = data or []
+        self._display = [RowDisplay(item) for item in self._data] # Параллельно _data
         self._headers = ["Select", "Slot", "Model", "Response", "Symbols", "Metrics & Status", "Preview"]
         self.active_model_names = set() # Имена моделей, которые нужно подсветить
 
@@ -25,26 +73,17 @@ class ResultsTableModel(QAbstractTableModel):
         if role == Qt.ItemDataRole.DisplayRole:
             if col == 1: return item.get('slot', 'P1')
             if col == 2: return item['model']
-            if col == 3: 
-                resp = item['response']
-                lines = resp.split('\n')
-                if len(lines) > 3:
-                    return "\n".join(lines[:3]) + "..."
-                return (resp[:200] + '...') if len(resp) > 200 else resp
-            if col == 4: return str(len(item['response']))
-            if col == 5: 
-                status = item['status']
-                t = item.get('resp_time', 0)
-                metrics = item.get('metrics', {})
-                avg = metrics.get('avg_time', 0)
-                errs = metrics.get('errors', 0)
-                
-                info = f"[{status}]"
-                if t > 0: info += f" {t:.1f}s"
-                if avg > 0 or errs > 0:
-                    info += f" (Avg:{avg}s | Err:{errs})"
-                return info
+            if col == 3: return self._display[row].preview
+            if col == 4: return self._display[row].symbols
+            if col == 5: return self._display[row].metrics
             if col == 6: return "🔍 Open"
+
+        if role == Qt.ItemDataRole.ToolTipRole and col == 4:
+            return f"~{self._display[row].tokens} tokens"
+        if role == Qt.ItemDataRole.ToolTipRole and col == 5:
+            histogram = (item.get('metrics') or {}).get('histogram')
+            if histogram:
+                return "Response time histogram: " + LatencySketch.histogram_text(histogram)
         
         if role == Qt.ItemDataRole.CheckStateRole and col == 0:
             return Qt.CheckState.Checked if item.get('selected') else Qt.CheckState.Unchecked
@@ -73,6 +112,7 @@ class ResultsTableModel(QAbstractTableModel):
         
         if role == Qt.ItemDataRole.EditRole and col == 3:
             self._data[row]['response'] = value
+            self._display[row] = RowDisplay(self._data[row])
             self.dataChanged.emit(index, index, [Qt.ItemDataRole.DisplayRole])
             return True
             
@@ -96,9 +136,102 @@ class ResultsTableModel(QAbstractTableModel):
         for item in self._data:
             if 'selected' not in item:
                 item['selected'] = False
+        self._display = [RowDisplay(item) for item in self._data]
         self.endResetModel()
 
+    def append_rows(self, items):
+        """Добавление строк в конец таблицы через beginInsertRows: уже показанные строки не перестраиваются."""
+        if not items:
+            return
+        first = len(self._data)
+        self.beginInsertRows(QModelIndex(), first, first + len(items) - 1)
+        for item in items:
+            item.setdefault('selected', False)
+            self._data.append(item)
+            self._display.append(RowDisplay(item))
+        self.endInsertRows()
+
+    def update_row(self, row):
+        """Точечное обновление одной строки после изменения ее данных: пересчет полей показа и dataChanged."""
+        if 0 <= row < len(self._data):
+            self._display[row] = RowDisplay(self._data[row])
+            self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount() - 1))
+
     def set_active_models(self, model_names):
         """Обновление списка имен моделей для подсветки."""
         self.active_model_names = set(model_names)
-        self.layoutChanged.emit()
+        # Меняется только фон: порядок и высота строк остаются прежними
+        if self._data:
+            self.dataChanged.emit(self.index(0, 0), self.index(len(self._data) - 1, self.columnCount() - 1),
+                                  [Qt.ItemDataRole.BackgroundRole])
+
+class ResultsPageModel(QAbstractTableModel):
+    """
+    Журнал сохраненных результатов с ленивой подгрузкой: строки читаются из SQLite страницами
+    по мере прокрутки (canFetchMore/fetchMore), только колонки для показа и с превью вместо полного текста.
+    При заданном запросе показывает результаты полнотекстового поиска с подсвеченными фрагментами.
+    """
+    PAGE_SIZE = 200
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._rows = []
+        self._headers = ["ID", "Prompt ID", "Model", "Response", "Date", "Prompt Content"]
+        self._exhausted = False
+        self.query = ""
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self._headers)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self._rows[index.row()][index.column()]
+        return None
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self._headers[section]
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self._exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self._exhausted:
+            return
+        if self.query:
+            # Результаты поиска идут по релевантности, а не по дате: страницы по смещению
+            page = db.search_results(self.query, self.PAGE_SIZE, len(self._rows))
+        else:
+            before = (self._rows[-1][4], self._rows[-1][0]) if self._rows else None
+            page = db.get_results_page(self.PAGE_SIZE, before)
+        self._exhausted = len(page) < self.PAGE_SIZE
+        if page:
+            self.beginInsertRows(QModelIndex(), len(self._rows), len(self._rows) + len(page) - 1)
+            self._rows.extend(page)
+            self.endInsertRows()
+
+    def set_query(self, text):
+        """Новый поиск: журнал перечитывается с первой страницы."""
+        self.query = text.strip()
+        self.refresh()
+
+    def refresh(self):
+        self.beginResetModel()
+        self._rows = []
+        self._exhausted = False
+        self.endResetModel()
+        self.fetchMore()
+
+    def result_id(self, row):
+        return self._rows[row][0]
+
+    def remove_row(self, row):
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self._rows[row]
+        self.endRemoveRows()